@@ -2,28 +2,40 @@
 
 import cgi
 import cgitb
-import os.path, sys, getopt, re
+import os.path, sys, getopt, re, multiprocessing
 import src.InvertedIndex as ii
+import src.SegmentedIndex as sg
 import src.Tokeniser as tk
 import src.WebIndexer as wi
 import src.VectorSpace as vs
-import src.SpellingCorrector as sc
 
 print "Content-type: text/html"
 print
 
 # form stuff
-# flag1 = form.getValue('flag1', 'False')
+form = cgi.FieldStorage()
+update = form.getvalue('update', 'False')
 
 index = ii.InvertedIndex()
 indexer = wi.WebIndexer()
 tokeniser = tk.Tokeniser()
-indexer.spimi(index, tokeniser)
+if update == 'True':
+    # Only index the new and modified pages, drop the deleted ones
+    indexer.update(index, tokeniser)
+else:
+    indexer.spimi(index, tokeniser, processes=multiprocessing.cpu_count())
 
+# spimi and update leave the index on disk, not in memory
+index = sg.openIndex()
 vSpace = vs.VectorSpace(index, indexer)
 vSpace.buildVectors()
 
-k = 3
-w, u, rss = vSpace.kMeans(k)
+# Cluster once here so queries can read the clusters from disk
+k = 8
+n = 10
+seed = 0
+w, u, rss = vSpace.kMeansBestOfN(k, n, seed)
+model = vs.ClusterModel(w, u, rss, k, n, seed, wi.generation(), vSpace.numberOfRows)
+model.save("index/clusters.npz")
 
 print pimp
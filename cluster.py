@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+"""
+NAME:
+    cluster.py - computes the document clusters offline
+
+SYNOPSIS:
+    python cluster.py [OPTIONS]
+
+DESCRIPTION:
+    Runs k-means (best of n seeds) on the current index and saves the
+    clustering to index/clusters.npz, where the search engine reads it instead
+    of clustering on every query. Rerun it after rebuilding the index.
+
+    -h, --help
+        display this prompt
+
+    -k, --clusters=K
+        number of clusters (8 by default)
+
+    -n, --seeds=N
+        number of random restarts, the lowest RSS is kept (10 by default)
+
+    -s, --seed=SEED
+        first random seed, restart i uses SEED+i (0 by default)
+
+    -i, --init=INIT
+        random: documents start in random clusters (by default)
+        kmeans++: clusters start around k spread out documents
+
+    -t, --tolerance=T
+        stops once the RSS changes by at most this fraction (0 by default:
+        once it stops changing)
+
+    -m, --max-iterations=M
+        stops after M iterations anyway (100 by default)
+
+    -b, --batch=SIZE
+        mini-batch k-means: each iteration only reads SIZE random documents,
+        for collections too large to cluster whole
+
+    -p, --prune
+        skips the distances that cannot change a cluster (Elkan): same
+        clusters, faster for large k
+"""
+
+import sys, getopt
+import src.SegmentedIndex as sg
+import src.WebIndexer as wi
+import src.VectorSpace as vs
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def build(k=8, n=10, seed=0, savefile="index/clusters.npz", **options):
+    """ Clusters the index on disk and saves the resulting ClusterModel
+    options: passed to VectorSpace.kMeans """
+    generation = wi.generation()
+    index = sg.openIndex()
+    indexer = wi.WebIndexer()
+    indexer.load()
+
+    vSpace = vs.VectorSpace(index, indexer)
+    vSpace.buildVectors()
+    w, u, rss = vSpace.kMeansBestOfN(k, n, seed, **options)
+
+    model = vs.ClusterModel(w, u, rss, k, n, seed, generation, vSpace.numberOfRows)
+    model.save(savefile)
+    return model
+
+def main(argv=None):
+    k = 8
+    n = 10
+    seed = 0
+    options = {}
+
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt( argv[1:], "hk:n:s:i:t:m:b:p", ["help", "clusters=", "seeds=", "seed=",
+                                        "init=", "tolerance=", "max-iterations=", "batch=", "prune"] )
+        except getopt.error, msg:
+            raise Usage(msg)
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print __doc__
+                return 0
+            if opt in ("-k", "--clusters"):
+                k = int(arg)
+            if opt in ("-n", "--seeds"):
+                n = int(arg)
+            if opt in ("-s", "--seed"):
+                seed = int(arg)
+            if opt in ("-i", "--init"):
+                if arg not in ("random", "kmeans++"):
+                    raise Usage("unknown init: " + arg)
+                options['init'] = arg
+            if opt in ("-t", "--tolerance"):
+                options['tolerance'] = float(arg)
+            if opt in ("-m", "--max-iterations"):
+                options['maxIterations'] = int(arg)
+            if opt in ("-b", "--batch"):
+                options['batchSize'] = int(arg)
+            if opt in ("-p", "--prune"):
+                options['pruning'] = True
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "for help use --help"
+        return 2
+
+    model = build(k, n, seed, **options)
+    print "k =", model.k, "RSS =", model.rss
+
+if __name__ == "__main__":
+    sys.exit(main())
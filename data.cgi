@@ -2,16 +2,18 @@
 
 import cgi
 import cgitb
-import sys, os, pickle
-import src.InvertedIndex as ii
+import sys, multiprocessing
+import src.SegmentedIndex as sg
 import src.WebIndexer as wi
 import src.VectorSpace as vs
 
 print "Content-type: text/html"
 print
 
-index = ii.InvertedIndex()
-ii.load("index/fullindex.csv", index)
+# Read before the index: if it is rebuilt meanwhile, the RSS are cached
+# under the older generation and computed again next time
+generation = wi.generation()
+index = sg.openIndex()
 indexer = wi.WebIndexer()
 indexer.load()
     
@@ -21,20 +23,17 @@ vSpace.buildVectors()
 minK = 2
 maxK = 15
 n = 2
+seed = 0
 
-results = []
-if not os.path.exists("index/kmeans"):
-    for k in range(minK, maxK+1):
-        print k
-        w, u, rss = vSpace.kMeansBestOfN(k, n*k)
-        results.append(rss)
-    pickle.dump(results, open("index/kmeans", "wb"))
-else:
-    results = pickle.load(open("index/kmeans", "rb"))
+# Restarts of every k in parallel, with the pruned iterations (same
+# result, fewer distances); each k is kept in index/kmeans as
+# soon as it is done, so an interrupted run resumes where it stopped
+results = vSpace.kMeansSweep(range(minK, maxK+1), n, seed, multiprocessing.cpu_count(),
+                             "index/kmeans", generation, pruning=True)
     
 print '{\n'
 for i in range(minK, maxK+1):
-    sys.stdout.write('\t"'+str(i)+'" : '+str(results[i-minK]))
+    sys.stdout.write('\t"'+str(i)+'" : '+str(results[i]))
     if i != (maxK):
         print ','
 print '\n}' 
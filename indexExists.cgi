@@ -4,7 +4,10 @@ import cgi
 import cgitb; cgitb.enable(display=0, logdir="/var/log/cgi-logs/")
 import os.path
 
-doesIt = os.path.exists("index/fullindex.csv") and os.path.exists("index/doclength.csv") and os.path.exists("index/urls.csv")
+# The manifest names the binary index (see src/SegmentedIndex.py); older
+# indexes were only saved as text
+doesIt = (os.path.exists("index/manifest") or os.path.exists("index/fullindex.csv")) and \
+         os.path.exists("index/doclength.csv") and os.path.exists("index/urls.csv")
 
 print "Content-type: text/html"
 print
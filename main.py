@@ -2,10 +2,12 @@
 
 import os.path, sys, getopt, re
 import src.InvertedIndex as ii
+import src.SegmentedIndex as sg
 import src.Tokeniser as tk
 import src.WebIndexer as wi
 import src.VectorSpace as vs
 import src.SpellingCorrector as sc
+import src.Retrieval as rt
 
 class Usage(Exception):
     def __init__(self, msg):
@@ -20,8 +22,7 @@ def main(argv=None):
     indexer.spimi(index, tokeniser)
     """
     # Sample: Loading the index (don't need to if you just indexed, see above)
-    index = ii.InvertedIndex()
-    ii.load("index/fullindex.csv", index)
+    index = sg.openIndex()
     indexer = wi.WebIndexer()
     indexer.load()
     
@@ -49,9 +50,16 @@ def main(argv=None):
     print terms
 
     # Sample: Edit distance
-    terms = [sc.correct(term) for term in terms]
+    corrector = sc.fromIndex(index)
+    terms = [corrector.correct(term) for term in terms]
     print terms
 
+    # Sample: Ranking from the postings of the query terms only
+    """
+    retrieval = rt.Retrieval(index, indexer)
+    print retrieval.documentAtATime(terms, 10)
+    """
+
     queryVector = vSpace.buildQueryVector(terms)
     docList = vSpace.nearestCluster(w, u, queryVector)
 
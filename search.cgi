@@ -2,52 +2,31 @@
 
 import cgi
 import cgitb; cgitb.enable(display=0, logdir="/var/log/cgi-logs/")
-import os.path, sys, getopt, re
-import src.InvertedIndex as ii
-import src.Tokeniser as tk
-import src.WebIndexer as wi
-import src.VectorSpace as vs
-import src.SpellingCorrector as sc
+import sys, socket, urllib, urllib2, httplib
 
 print "Content-type: text/html"
 print
 
+# Port of the search daemon (searchd.py)
+port = 8479
+numberOfResults = 10
+
 form = cgi.FieldStorage()
 userInput = form.getvalue("searchQuery", "")
 
-if (userInput != ""):	
-	# Sample: Loading the index (don't need to if you just indexed, see above)
-    	index = ii.InvertedIndex()
-    	ii.load("index/fullindex.csv", index)
-    	indexer = wi.WebIndexer()
-    	indexer.load()
-    	
-	# Sample: Generating the vector space
-    	vSpace = vs.VectorSpace(index, indexer)
-    	vSpace.buildVectors()
-
-	k = 8
-	n = 10
-	w, u, rss = vSpace.kMeansBestOfN(k, n)
-
-	tokeniser = tk.Tokeniser()
-
-	numberOfResults = 10
-
-	terms = tokeniser.tokenise(userInput)
-	terms = [sc.correct(term) for term in terms]
-
-	queryVector = vSpace.buildQueryVector(terms)
-
-	closestCluster = vSpace.nearestCluster(w, u, queryVector)
-
-	docList = vSpace.cosineSort(range(len(vSpace.vectorIndex)), closestCluster, queryVector)[:numberOfResults]
-
-	urlList = [indexer.urls[docId] for docId in docList]
-
-	print '{\n'
-	for i in range(len(urlList)):
-		sys.stdout.write( '\t"' + str(i+1) + '" : "' + urlList[i] + '"')
-		if i != (len(urlList) -1):
-			print ','
-	print '\n}'
+if (userInput != ""):
+	query = urllib.urlencode({ "searchQuery": userInput, "n": numberOfResults })
+	try:
+		# Thin client: the daemon keeps the index, vectors and clusters loaded
+		response = urllib2.urlopen("http://127.0.0.1:%d/search?%s" % (port, query), timeout=30)
+		try:
+			print response.read()
+		finally:
+			response.close()
+	except (urllib2.URLError, socket.error, httplib.HTTPException):
+		# Daemon is not running (or dropped the connection): load everything
+		# and answer in-process.
+		# Imported here so the thin client does not pay for loading the index.
+		import src.SearchEngine as se
+		engine = se.SearchEngine()
+		print se.toJSON(engine.search(userInput, numberOfResults))
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+"""
+NAME:
+    searchd.py - long-lived search daemon
+
+SYNOPSIS:
+    python searchd.py [OPTIONS]
+
+DESCRIPTION:
+    Loads the index, vectors and clusters once and answers queries over HTTP:
+        GET /search?searchQuery=QUERY[&n=RESULTS]
+    search.cgi forwards its queries here. Queries are served concurrently
+    against the same in-memory engine. When a new index generation, a
+    compacted index or new clusters are written to disk, a new engine is
+    loaded in the background and swapped in once it is complete; queries
+    never see a partially loaded index.
+
+    -h, --help
+        display this prompt
+
+    -p, --port=PORT
+        port to listen on, on the loopback interface (8479 by default)
+
+    -r, --reload=SECONDS
+        how often to check the disk for a new index or clusters (5 by default)
+"""
+
+import sys, getopt, threading, time, urlparse
+import BaseHTTPServer, SocketServer
+import src.SearchEngine as se
+
+port = 8479
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+class SearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    engine = None       # Replaced as a whole on reload, never modified
+
+class SearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/search':
+            self.send_error(404)
+            return
+        form = urlparse.parse_qs(url.query)
+        userInput = form.get('searchQuery', [''])[0]
+        try:
+            numberOfResults = int(form.get('n', ['10'])[0])
+        except ValueError:
+            self.send_error(400, "n must be an integer")
+            return
+        if numberOfResults < 1:
+            self.send_error(400, "n must be at least 1")
+            return
+
+        # Keep a reference: a reload may swap the server's engine meanwhile
+        engine = self.server.engine
+        urlList = []
+        if userInput != "":
+            try:
+                urlList = engine.search(userInput, numberOfResults)
+            except Exception, e:
+                # Answer rather than drop the connection; the client falls back
+                print >>sys.stderr, "Search failed:", e
+                self.send_error(500)
+                return
+        body = se.toJSON(urlList)
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def reloader(server, interval):
+    """ Swaps in a new engine whenever a newer index or clustering is on disk """
+    while True:
+        time.sleep(interval)
+        try:
+            if server.engine.isStale():
+                server.engine = se.SearchEngine()
+        except Exception, e:
+            # Keep serving the previous generation
+            print >>sys.stderr, "Reload failed:", e
+
+def main(argv=None):
+    listenPort = port
+    interval = 5.0
+
+    if argv is None:
+        argv = sys.argv
+    try:
+        try:
+            opts, args = getopt.getopt( argv[1:], "hp:r:", ["help", "port=", "reload="] )
+        except getopt.error, msg:
+            raise Usage(msg)
+        for opt, arg in opts:
+            if opt in ("-h", "--help"):
+                print __doc__
+                return 0
+            if opt in ("-p", "--port"):
+                listenPort = int(arg)
+            if opt in ("-r", "--reload"):
+                interval = float(arg)
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        print >>sys.stderr, "for help use --help"
+        return 2
+
+    server = SearchServer(('127.0.0.1', listenPort), SearchHandler)
+    print "Loading index..."
+    server.engine = se.SearchEngine()
+
+    thread = threading.Thread(target=reloader, args=(server, interval))
+    thread.daemon = True
+    thread.start()
+
+    print "Listening on port", listenPort
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""BinaryIndex.py
+
+Binary on-disk format for the inverted index, read through mmap so that
+nothing has to be parsed or loaded into dictionaries at start up.
+
+An index saved under a base name is made of two files:
+    base.dict   sorted term dictionary:
+                    header      magic, version, number of terms, skip
+                                interval (16 bytes)
+                    termStart   (terms+1) uint64, offsets of the terms in the
+                                term blob
+                    postStart   (terms) uint64, offsets of the postings
+                                lists in base.post
+                    postLength  (terms) uint32, sizes of the postings lists
+                    df          (terms) uint32, document frequencies
+                    blob        the terms, concatenated in sorted order
+    base.post   compressed postings lists, in the order they were written.
+                Each list is:
+                    skips       one (docId, offset) uint32 pair for every
+                                skipInterval postings after the first block:
+                                the last docId of the previous block and where
+                                the block starts in the data
+                    data        variable-byte integers, alternating docId gap
+                                (from the previous docId, or from 0 for the
+                                first posting) and termFreq
+
+Variable-byte integers use 7 bits per byte, least significant group first,
+the high bit marking every byte but the last.
+
+MappedIndex reads a saved index with the same interface as InvertedIndex
+(tf, df, index[term], term in index, iteration over the terms), looking
+terms up by binary search in the mapped dictionary. tf only decodes the block
+the docId falls in, and iterPostings decodes a list lazily.
+"""
+
+import csv, heapq, mmap, os, struct
+from numpy import *
+import InvertedIndex as ii
+
+magic = 'CRIX'
+version = 2
+header = struct.Struct('<4sIII')
+skipInterval = 64
+
+# Variable-byte codec
+
+def encodeVarints(values):
+    """ Encodes an array of non-negative integers (below 2**35) as bytes """
+    values = asarray(values, dtype=uint64)
+    sizes = ones(len(values), dtype=int64)
+    for j in range(1, 5):
+        sizes += values >= 2**(7*j)
+    starts = zeros(len(values), dtype=int64)
+    cumsum(sizes[:-1], out=starts[1:])
+    out = zeros(int(sizes.sum()), dtype=uint8)
+    for j in range(5):
+        present = sizes > j
+        part = (values[present] >> uint64(7*j)) & uint64(127)
+        more = (sizes[present] > j+1).astype(uint64) << uint64(7)
+        out[starts[present] + j] = part | more
+    return out.tostring()
+
+def decodeVarints(data):
+    """ Decodes a string of variable-byte integers into a uint64 array """
+    b = frombuffer(data, dtype=uint8)
+    if len(b) == 0:
+        return zeros(0, dtype=uint64)
+    ends = flatnonzero(b < 128)
+    starts = zeros(len(ends), dtype=int64)
+    starts[1:] = ends[:-1] + 1
+    group = repeat(arange(len(ends)), ends - starts + 1)
+    shift = (7*(arange(len(b)) - starts[group])).astype(uint64)
+    parts = (b & 127).astype(uint64) << shift
+    return bitwise_or.reduceat(parts, starts)
+
+def encodePostings(postings):
+    """ Compresses a (n, 2) array of (docId, termFreq) ordered by docId.
+    Returns the skips and the data, as strings """
+    postings = asarray(postings, dtype=int64).reshape(-1, 2)
+    gaps = diff(concatenate(([0], postings[:,0])))
+    interleaved = empty(2*len(postings), dtype=int64)
+    interleaved[0::2] = gaps
+    interleaved[1::2] = postings[:,1]
+    data = encodeVarints(interleaved)
+    # A posting ends with its second varint
+    ends = flatnonzero(frombuffer(data, dtype=uint8) < 128)
+    firsts = arange(skipInterval, len(postings), skipInterval)
+    skips = empty((len(firsts), 2), dtype='<u4')
+    skips[:,0] = postings[firsts-1,0]
+    skips[:,1] = ends[2*firsts-1] + 1
+    return skips.tostring(), data
+
+def decodePostings(data, base=0):
+    """ Decompresses postings data into a (n, 2) int64 array """
+    values = decodeVarints(data).astype(int64)
+    postings = empty((len(values)//2, 2), dtype=int64)
+    postings[:,0] = cumsum(values[0::2]) + base
+    postings[:,1] = values[1::2]
+    return postings
+
+def iterDecode(data, base=0):
+    """ Streaming decoder: yields (docId, termFreq) one posting at a time """
+    docId = base
+    value = 0
+    shift = 0
+    gap = None
+    for c in data:
+        byte = ord(c)
+        value |= (byte & 127) << shift
+        if byte & 128:
+            shift += 7
+            continue
+        if gap is None:
+            gap = value
+        else:
+            docId += gap
+            yield docId, value
+            gap = None
+        value = 0
+        shift = 0
+
+def combine(parts):
+    """ Merges postings arrays of one term into one, adding the frequencies
+    of documents found in more than one part """
+    postings = concatenate(parts)
+    docIds = postings[:,0]
+    if len(docIds) > 1 and (diff(docIds) <= 0).any():
+        docIds, inverse = unique(docIds, return_inverse=True)
+        freqs = bincount(inverse, weights=postings[:,1]).astype(int64)
+        postings = column_stack((docIds, freqs))
+    return postings
+
+# I/O
+
+def encodeTerm(term):
+    if isinstance(term, unicode):
+        return term.encode('utf-8')
+    return term
+
+class Writer:
+    """ Writes a binary index one postings list at a time.
+    Terms can be added in any order, only the dictionary (terms, offsets,
+    document frequencies) is kept in memory until close().
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.post = open(base + '.post', 'wb')
+        self.offset = 0
+        self.entries = []   # (term, postings offset, postings size, df)
+
+    def add(self, term, postings):
+        """ postings: [ [docId, termFreq], ... ] (or an array) ordered by docId """
+        skips, data = encodePostings(postings)
+        self.post.write(skips)
+        self.post.write(data)
+        size = len(skips) + len(data)
+        self.entries.append( (encodeTerm(term), self.offset, size, len(postings)) )
+        self.offset += size
+
+    def close(self):
+        self.post.close()
+        self.entries.sort()
+        n = len(self.entries)
+        termStart = zeros(n+1, dtype='<u8')
+        postStart = zeros(n, dtype='<u8')
+        postLength = zeros(n, dtype='<u4')
+        df = zeros(n, dtype='<u4')
+        position = 0
+        for i in range(n):
+            term, start, size, count = self.entries[i]
+            termStart[i] = position
+            postStart[i] = start
+            postLength[i] = size
+            df[i] = count
+            position += len(term)
+        termStart[n] = position
+        f = open(self.base + '.dict', 'wb')
+        try:
+            f.write(header.pack(magic, version, n, skipInterval))
+            f.write(termStart.tostring())
+            f.write(postStart.tostring())
+            f.write(postLength.tostring())
+            f.write(df.tostring())
+            f.write(''.join([ entry[0] for entry in self.entries ]))
+        finally:
+            f.close()
+        self.entries = []
+
+def save(base, index):
+    """ Saves an InvertedIndex in the binary format """
+    writer = Writer(base)
+    for term in index:
+        writer.add(term, index[term])
+    writer.close()
+
+def convert(csvfile, base):
+    """ Converts an index saved as CSV (see InvertedIndex.save) to the binary
+    format, one row at a time """
+    writer = Writer(base)
+    try:
+        f = open(csvfile, 'rb')
+        reader = csv.DictReader(f)
+        for row in reader:
+            writer.add(row['term'], ii.parsePostings(row['posting']))
+    finally:
+        f.close()
+    writer.close()
+
+def saveCSV(base, csvfile):
+    """ Writes a binary index as a CSV (see InvertedIndex.save), one term at
+    a time, in sorted order. The file is replaced once complete. """
+    index = MappedIndex(base)
+    try:
+        f = open(csvfile + '.tmp', 'wb')
+        fields = ('term', 'posting')
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writerow(dict((n,n) for n in fields))
+        for i in xrange(len(index)):
+            posting = ','.join([ '%d:%d' % (docId, tf) for docId, tf in index.postingsAt(i) ])
+            writer.writerow( { fields[0]:index.term(i), fields[1]:posting } )
+    finally:
+        f.close()
+        index.close()
+    os.rename(csvfile + '.tmp', csvfile)
+
+def exists(base):
+    return os.path.exists(base + '.dict') and os.path.exists(base + '.post')
+
+def remove(base):
+    """ Deletes the files of a binary index (those that exist) """
+    for ext in ('.dict', '.post'):
+        if os.path.exists(base + ext):
+            os.remove(base + ext)
+
+def mapFile(filename):
+    """ Read only memory map of a file (an empty string for an empty file) """
+    f = open(filename, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+# MERGE
+
+def termStream(index, block):
+    """ (term, block, position) for every term of a MappedIndex, in order """
+    for i in xrange(len(index)):
+        yield index.term(i), block, i
+
+def merge(mergedBase, blockBases):
+    """
+    Merges binary indexes (e.g. SPIMI blocks) into one.
+    The blocks' sorted dictionaries are read in parallel (k-way merge), so
+    only the postings of one term are decoded at a time.
+    """
+    blocks = [ MappedIndex(base) for base in blockBases ]
+    writer = Writer(mergedBase)
+    try:
+        streams = [ termStream(blocks[j], j) for j in range(len(blocks)) ]
+        current = None
+        parts = []
+        for term, j, i in heapq.merge(*streams):
+            if term != current:
+                if parts:
+                    writer.add(current, combine(parts))
+                current = term
+                parts = []
+            parts.append(blocks[j].postingsAt(i))
+        if parts:
+            writer.add(current, combine(parts))
+    finally:
+        writer.close()
+        for block in blocks:
+            block.close()
+
+class MappedIndex:
+    """ Read only inverted index over a binary index (see Writer) """
+
+    def __init__(self, base):
+        self.dictMap = mapFile(base + '.dict')
+        self.postMap = mapFile(base + '.post')
+        fileMagic, fileVersion, n, interval = header.unpack_from(self.dictMap, 0)
+        if fileMagic != magic or fileVersion != version:
+            raise IOError("%s.dict is not a binary index (version %d)" % (base, version))
+        self.numberOfTerms = n
+        self.skipInterval = interval
+        offset = header.size
+        self.termStart = frombuffer(self.dictMap, dtype='<u8', count=n+1, offset=offset)
+        offset += 8*(n+1)
+        self.postStart = frombuffer(self.dictMap, dtype='<u8', count=n, offset=offset)
+        offset += 8*n
+        self.postLength = frombuffer(self.dictMap, dtype='<u4', count=n, offset=offset)
+        offset += 4*n
+        self.dfs = frombuffer(self.dictMap, dtype='<u4', count=n, offset=offset)
+        offset += 4*n
+        self.blobStart = offset
+
+    def close(self):
+        for m in (self.dictMap, self.postMap):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+    def term(self, i):
+        """ The i-th term in sorted order """
+        start = self.blobStart + int(self.termStart[i])
+        return self.dictMap[start:self.blobStart + int(self.termStart[i+1])]
+
+    def find(self, term):
+        """ Position of term in the dictionary (binary search), -1 if absent """
+        term = encodeTerm(term)
+        lo = 0
+        hi = self.numberOfTerms
+        while lo < hi:
+            mid = (lo+hi)//2
+            midval = self.term(mid)
+            if midval < term:
+                lo = mid+1
+            elif midval > term:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def skipsAt(self, i):
+        """ Skip pointers of the i-th term as a (skips, 2) array, and the
+        offset of its compressed data in base.post """
+        start = int(self.postStart[i])
+        count = (int(self.dfs[i]) - 1) // self.skipInterval
+        skips = frombuffer(self.postMap, dtype='<u4', count=2*count, offset=start).reshape(count, 2)
+        return skips, start + 8*count
+
+    def dataAt(self, i):
+        """ Compressed postings data of the i-th term """
+        skips, start = self.skipsAt(i)
+        return self.postMap[start:int(self.postStart[i]) + int(self.postLength[i])]
+
+    def postingsAt(self, i):
+        """ Postings of the i-th term, as a (df, 2) array of (docId, termFreq) """
+        return decodePostings(self.dataAt(i))
+
+    def iterPostings(self, term):
+        """ Yields the (docId, termFreq) of a term, decoding as it goes """
+        i = self.find(term)
+        if i < 0:
+            return iter([])
+        return iterDecode(self.dataAt(i))
+
+    def __len__(self):
+        return self.numberOfTerms
+
+    def __iter__(self):
+        for i in xrange(self.numberOfTerms):
+            yield self.term(i)
+
+    def keys(self):
+        return list(self)
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __getitem__(self, term):
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.postingsAt(i)
+
+    def tf(self, term, docId):
+        """ Return the term frequency for a given term and docId.
+        Only the block that can hold docId (found with the skips) is decoded """
+        i = self.find(term)
+        if i < 0:
+            return 0
+        skips, start = self.skipsAt(i)
+        dataLength = int(self.postStart[i]) + int(self.postLength[i]) - start
+        block = int(skips[:,0].searchsorted(docId))
+        base, lo, hi = 0, 0, dataLength
+        if block > 0:
+            base, lo = int(skips[block-1,0]), int(skips[block-1,1])
+        if block < len(skips):
+            hi = int(skips[block,1])
+        for entry, tf in iterDecode(self.postMap[start+lo:start+hi], base):
+            if entry == docId:
+                return tf
+            if entry > docId:
+                break
+        return 0
+
+    def df(self, term):
+        """ Return the document frequency for a given term """
+        i = self.find(term)
+        if i < 0:
+            return 0
+        return int(self.dfs[i])
+
+    def totalFreq(self, term):
+        return int(self[term][:,1].sum())
+
+    def frequencies(self):
+        index = {}
+        for i in xrange(self.numberOfTerms):
+            index[self.term(i)] = int(self.postingsAt(i)[:,1].sum())
+        return index
+
+    def statistics(self):
+        """ Maps each term to its (df, cf, max tf), see
+        InvertedIndex.writeVocabulary """
+        stats = {}
+        for i in xrange(self.numberOfTerms):
+            tfs = self.postingsAt(i)[:,1]
+            stats[self.term(i)] = (int(self.dfs[i]), int(tfs.sum()), int(tfs.max()))
+        return stats
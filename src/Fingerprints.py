@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Fingerprints.py
+
+Fingerprints of the indexed pages, to skip duplicates while indexing and to
+remember them from one build to the next (index/fingerprints.csv).
+
+Exact duplicates are found by the MD5 digest of the page body, in a dict.
+Optionally, near duplicates are found by SimHash: a 64 bit fingerprint of the
+page's words where similar pages differ in few bits. Two pages are near
+duplicates if their SimHashes differ in at most `distance` bits.
+The SimHashes are cut in distance+1 bands; by the pigeonhole principle two
+fingerprints within distance bits of each other agree on at least one band,
+so only the pages sharing a band with the new one are compared.
+"""
+
+import re, csv, hashlib
+from numpy import *
+
+regexWord = re.compile(r'\w+', flags=re.UNICODE)
+
+def simhash(text):
+    """ 64 bit SimHash of the words of a text, weighted by their counts """
+    counts = {}
+    for word in regexWord.findall(text.lower()):
+        counts[word] = counts.get(word, 0) + 1
+    if not counts:
+        return 0
+    words = counts.keys()
+    digests = ''.join([ hashlib.md5(word.encode("utf8")).digest()[:8] for word in words ])
+    bits = unpackbits(frombuffer(digests, dtype=uint8).reshape(len(words), 8), axis=1)
+    weights = array([ counts[word] for word in words ], dtype=int64)
+    votes = dot(weights, 2*bits.astype(int64) - 1)
+    return int(''.join([ '1' if vote > 0 else '0' for vote in votes ]), 2)
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class Fingerprints:
+    digests = {}        # Maps MD5 digest to docId
+    docs = {}           # Maps docId to MD5 digest
+    simhashes = {}      # Maps docId to SimHash
+    bands = {}          # Maps (band, value) to the docIds having it
+    distance = None     # Maximum distance of near duplicates, None if off
+
+    def __init__(self, distance=None):
+        """ Fingerprints
+        distance:   SimHashes at most this many bits apart are duplicates;
+                    None to only detect exact duplicates
+        """
+        self.digests = {}
+        self.docs = {}
+        self.simhashes = {}
+        self.bands = {}
+        self.distance = distance
+
+    def __len__(self):
+        return len(self.digests)
+
+    def bandsOf(self, fingerprint):
+        """ The (band, value) keys of a SimHash """
+        n = self.distance + 1
+        width = 64 // n
+        keys = []
+        for band in range(n):
+            shift = band*width
+            if band == n-1:
+                width = 64 - shift
+            keys.append( (band, (fingerprint >> shift) & ((1 << width) - 1)) )
+        return keys
+
+    def duplicateOf(self, digest, fingerprint=None):
+        """ docId of a page the new one duplicates, or None """
+        docId = self.digests.get(digest)
+        if docId is not None or self.distance is None or fingerprint is None:
+            return docId
+        for key in self.bandsOf(fingerprint):
+            for docId in self.bands.get(key, ()):
+                if hamming(fingerprint, self.simhashes[docId]) <= self.distance:
+                    return docId
+        return None
+
+    def digestOf(self, docId):
+        return self.docs.get(docId)
+
+    def add(self, docId, digest, fingerprint=None):
+        self.digests[digest] = docId
+        self.docs[docId] = digest
+        if fingerprint is not None:
+            self.simhashes[docId] = fingerprint
+            if self.distance is not None:
+                for key in self.bandsOf(fingerprint):
+                    self.bands.setdefault(key, []).append(docId)
+
+    def remove(self, docId):
+        """ Forgets a page (deleted or modified) """
+        digest = self.docs.pop(docId, None)
+        if digest is not None and self.digests.get(digest) == docId:
+            del self.digests[digest]
+        fingerprint = self.simhashes.pop(docId, None)
+        if fingerprint is not None and self.distance is not None:
+            for key in self.bandsOf(fingerprint):
+                self.bands[key].remove(docId)
+
+    def unique(self, docId, digest, fingerprint=None):
+        """ Adds the fingerprints of a page as docId unless it is a duplicate;
+        returns False for duplicates """
+        if self.duplicateOf(digest, fingerprint) is not None:
+            return False
+        self.add(docId, digest, fingerprint)
+        return True
+
+    def save(self, savefile):
+        """ One row per page: docId, hex MD5 digest, SimHash (may be empty) """
+        try:
+            f = open(savefile, 'wb')
+            fields = ('docId', 'digest', 'simhash')
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writerow(dict((n,n) for n in fields))
+            for docId, digest in sorted(self.docs.items()):
+                writer.writerow( { fields[0]:docId, fields[1]:digest.encode('hex'),
+                                   fields[2]:self.simhashes.get(docId, '') } )
+        finally:
+            f.close()
+
+    def load(self, loadfile):
+        distance = self.distance
+        self.__init__(distance)
+        try:
+            f = open(loadfile, 'rb')
+            reader = csv.DictReader(f)
+            for row in reader:
+                fingerprint = None
+                if row['simhash']:
+                    fingerprint = long(row['simhash'])
+                self.add(int(row['docId']), row['digest'].decode('hex'), fingerprint)
+        finally:
+            f.close()
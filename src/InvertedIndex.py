@@ -9,9 +9,18 @@ key, and a list of 2-value lists as the value:
 Overrides the __setitem__ method to manage the postings list using regular inserts.
 
 Includes functionality to save to, and load from, a csv file.
+
+The vocabulary (index/vocabulary.csv) is the table of the term statistics,
+computed when the index is built: for each term its column in the vectors,
+idf, df, collection frequency (cf, total of its term frequencies) and largest
+term frequency.
 """
 
-import csv
+import csv, math
+
+# Approximate memory used by the index, measured on 64-bit CPython 2.7
+termBytes    = 200  # Key, dictionary slot and empty postings list
+postingBytes = 120  # [docId, termFreq] list, its slot and the docId int
 
 def merge(left, right):
     """ Merge two sorted lists without duplicates
@@ -35,6 +44,7 @@ def merge(left, right):
     return result
 
 class InvertedIndex(dict):
+    numberOfPostings = 0    # Postings added through = (see memoryEstimate)
 
     def __setitem__(self, key, value):
         """ Overides = operator: set new list or append new docId """
@@ -42,9 +52,11 @@ class InvertedIndex(dict):
             if key not in self:
                 # New term & new document
                 dict.__setitem__( self, key, [ [value, 1] ] )
+                self.numberOfPostings += 1
             elif value > self[key][-1][0]:
                 # New document
                 self[key].append( [value, 1] )
+                self.numberOfPostings += 1
             elif value == self[key][-1][0]:
                 # Old document: increment term frequency
                 self[key][-1][1] += 1
@@ -52,10 +64,21 @@ class InvertedIndex(dict):
                 raise TypeError("InvertedIndex postings must be ordered")
         elif isinstance(value, list):
             # Set new postings list for this term
+            if key in self:
+                self.numberOfPostings -= len(self[key])
             dict.__setitem__(self, key, value)
+            self.numberOfPostings += len(value)
         else:
             raise TypeError("InvertedIndex value must be an 'int', or a list")
 
+    def clear(self):
+        dict.clear(self)
+        self.numberOfPostings = 0
+
+    def memoryEstimate(self):
+        """ Approximate number of bytes used by the index, in O(1) """
+        return len(self)*termBytes + self.numberOfPostings*postingBytes
+
     def totalFreq(self, term):
         count = 0
         for entry in self[term]:
@@ -94,6 +117,14 @@ class InvertedIndex(dict):
 
 # I/O 
 
+def parsePostings(posting):
+    """ "docId1:termFreq1,docId2:termFreq2..." to a postings list """
+    return [ [ int(i) for i in doc.split(':') ] for doc in posting.split(',') ]
+
+def formatPostings(postings):
+    """ Postings list to a string: "docId1:termFreq1,docId2:termFreq2..." """
+    return ','.join( [ ':'.join( [ str(i) for i in doc ] ) for doc in postings ] )
+
 def save(savefile, index):
     """ Saves the inverted index as a CSV
     Inspired by: http://www.doughellmann.com/PyMOTW/csv/#using-field-names
@@ -104,9 +135,7 @@ def save(savefile, index):
         writer = csv.DictWriter(f, fieldnames=fields)
         writer.writerow(dict((n,n) for n in fields))
         for key in index:
-            # Convert postings list to a string: "docId1:termFreq1,docId2:termFreq2..."
-            posting = ','.join( [ ':'.join( [ str(i) for i in doc ] ) for doc in index[key] ] )
-            writer.writerow( { fields[0]:key, fields[1]:posting } )
+            writer.writerow( { fields[0]:key, fields[1]:formatPostings(index[key]) } )
     finally:
         f.close()
 
@@ -119,10 +148,79 @@ def load(loadfile, index):
         f = open(loadfile, 'rb')
         reader = csv.DictReader(f)
         for row in reader:
-            # Convert from string to postings list
-            index[row['term']] = [ [ int(i) for i in doc.split(':') ] for doc in row['posting'].split(',') ]
+            index[row['term']] = parsePostings(row['posting'])
+    finally:
+        f.close()
+
+def statistics(postings):
+    """ (df, cf, max tf) of a postings list """
+    tfs = [ int(entry[1]) for entry in postings ]
+    return len(tfs), sum(tfs), max(tfs)
+
+def saveVocabulary(savefile, indexfile, numberOfDocs):
+    """ Saves the vocabulary of the index saved in indexfile as a CSV:
+    term, column (the term's position in sorted order), idf, df, cf and
+    maxtf.
+    Streams indexfile, only the terms and their statistics are kept in memory.
+    """
+    stats = {}
+    try:
+        f = open(indexfile, 'rb')
+        reader = csv.DictReader(f)
+        for row in reader:
+            stats[row['term']] = statistics(parsePostings(row['posting']))
+    finally:
+        f.close()
+    writeVocabulary(savefile, stats, numberOfDocs)
+
+def writeVocabulary(savefile, stats, numberOfDocs):
+    """ Saves a vocabulary (see saveVocabulary) from a dictionary mapping
+    each term to its (df, cf, max tf) """
+    try:
+        f = open(savefile, 'wb')
+        fields = ('term', 'column', 'idf', 'df', 'cf', 'maxtf')
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writerow(dict((n,n) for n in fields))
+        column = 0
+        for term in sorted(stats):
+            df, cf, maxTf = stats[term]
+            idf = math.log( (float(numberOfDocs)/df), 10 )
+            writer.writerow( { fields[0]:term, fields[1]:column, fields[2]:repr(idf),
+                               fields[3]:df, fields[4]:cf, fields[5]:maxTf } )
+            column += 1
+    finally:
+        f.close()
+
+def loadVocabulary(loadfile):
+    """ Loads a vocabulary saved with saveVocabulary
+    Returns a dictionary mapping terms to columns, and the list of idf
+    values by column.
+    """
+    columns = {}
+    idf = []
+    try:
+        f = open(loadfile, 'rb')
+        reader = csv.DictReader(f)
+        for row in reader:
+            columns[row['term']] = int(row['column'])
+            idf.append(float(row['idf']))
+    finally:
+        f.close()
+    return columns, idf
+
+def loadStatistics(loadfile):
+    """ Loads the term statistics of a vocabulary saved with saveVocabulary
+    Returns a dictionary mapping terms to (df, cf, idf, max tf).
+    """
+    stats = {}
+    try:
+        f = open(loadfile, 'rb')
+        reader = csv.DictReader(f)
+        for row in reader:
+            stats[row['term']] = ( int(row['df']), int(row['cf']), float(row['idf']), int(row['maxtf']) )
     finally:
         f.close()
+    return stats
 
 # MERGE
 
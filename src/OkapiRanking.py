@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""OkapiRanking.py
+
+Ranks documents with Okapi BM25, from the postings lists of the query terms
+only (no tf-idf vectors):
+    RSV(d) = sum( idf[t] * (k+1)*tf[t,d] / ( k*((1-b) + b*L[d]/avgL) + tf[t,d] ) )
+over the distinct query terms t in the index, where L[d] is the length of
+document d (WebIndexer.docL) and avgL the average length.
+
+The length normalization k*((1-b) + b*L[d]/avgL) only depends on the
+document and on k and b: it is kept as an array indexed by docId for every
+(k, b) used so far. Nothing else changes after construction, so one
+OkapiRanking can rank the queries of several threads.
+"""
+
+import math
+from numpy import zeros, array, int64, flatnonzero, argpartition, lexsort
+
+class OkapiRanking:
+    index = None
+    indexer = None
+    numberOfDocs = 0
+    lengths = None          # Length of every docId (0 if unused)
+    avgL = 0.0
+    normalizations = None   # Maps (k, b) to k*((1-b) + b*L[d]/avgL) by docId
+
+    def __init__(self, iIndex, iIndexer, k=1.2, b=0.75):
+        self.index = iIndex
+        self.indexer = iIndexer
+        self.numberOfDocs = len(self.indexer.docL)
+        size = max(self.indexer.docL) + 1 if self.indexer.docL else 0
+        self.lengths = zeros(size)
+        for docId, length in self.indexer.docL.items():
+            self.lengths[docId] = length
+        if self.numberOfDocs:
+            self.avgL = self.indexer.avgL()
+        self.normalizations = {}
+        self.normalization(k, b)
+
+    def normalization(self, k, b):
+        """ The length normalization of every docId for k and b """
+        result = self.normalizations.get((k, b))
+        if result is None:
+            result = k*((1.0-b) + b*self.lengths/max(self.avgL, 1e-12))
+            # Two threads may both compute it, either array will do
+            self.normalizations[(k, b)] = result
+        return result
+
+    def computeIDF(self, term):
+        df = self.index.df(term)
+        return math.log( (float(self.numberOfDocs)/df), 10 )
+
+    def scores(self, terms, k=1.2, b=0.75, n=10):
+        """ Returns the n best (docId, score), best first; smaller docIds
+        first on ties """
+        normalization = self.normalization(k, b)
+        rsv = zeros(len(self.lengths))
+        for term in set(terms):
+            if term not in self.index:
+                continue
+            postings = array(self.index[term], dtype=int64).reshape(-1, 2)
+            docIds, tf = postings[:,0], postings[:,1]
+            # docIds are unique within a postings list
+            rsv[docIds] += self.computeIDF(term)*(k+1)*tf/(normalization[docIds]+tf)
+        candidates = flatnonzero(rsv)
+        if n < 1 or len(candidates) == 0:
+            return []
+        if len(candidates) > n:
+            # Every candidate scoring at least the n-th best score, so that
+            # ties on it are broken by docId below
+            scores = rsv[candidates]
+            nth = scores[argpartition(-scores, n-1)[n-1]]
+            candidates = candidates[scores >= nth]
+        best = candidates[lexsort((candidates, -rsv[candidates]))][:n]
+        return [ (int(docId), rsv[docId]) for docId in best ]
+
+    def rsv(self, terms, k=1.2, b=0.75, n=10):
+        """ Returns the docIds of the n best documents, best first """
+        return [ docId for docId, score in self.scores(terms, k, b, n) ]
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""Retrieval.py
+
+Ranks documents by walking only the postings lists of the query terms, instead
+of scoring every document in the vector space.
+
+Scores are the same tf-idf cosine as VectorSpace.queryCosine (without the
+cluster boost):
+    score(d) = sum( qw[t] * tf[t,d] * idf[t] ) / ( |q| * |d| + 1 )
+Only documents containing at least one query term get a score.
+
+Two strategies are provided:
+    - termAtATime:      one postings list after the other, adding to score
+                        accumulators
+    - documentAtATime:  all postings lists in parallel, in docId order, with
+                        MaxScore pruning: each term has an upper bound on what
+                        it can add to a score, and documents that only contain
+                        terms whose bounds cannot reach the current top n are
+                        never scored; those terms are only looked up for
+                        documents that can still make it, moving their
+                        cursors forward by binary search.
+The idf of the terms is read from the term statistics of the index
+(InvertedIndex.loadStatistics) when they are given.
+"""
+
+import math, heapq
+from numpy import zeros, sqrt, maximum, array, int64
+import VectorSpace as vs
+
+class Retrieval:
+    index = None
+    indexer = None
+    numberOfDocs = 0
+    norms = None        # Length of every document's tf-idf vector
+    maxWeight = None    # Maps each term to max( tf*idf / |d| ) over its postings
+    statistics = None   # Maps each term to (df, cf, idf, max tf), if given
+
+    def __init__(self, iIndex, iIndexer, statistics=None):
+        """ Precomputes the document lengths and the per-term upper bounds
+        (a single pass over the postings) """
+        self.index = iIndex
+        self.indexer = iIndexer
+        self.statistics = statistics
+        self.numberOfDocs = len(self.indexer.docL)
+        size = max(self.indexer.docL) + 1 if self.indexer.docL else 0
+
+        squares = zeros(size)
+        for term in self.index:
+            idf = self.computeIDF(term)
+            for entry in self.index[term]:
+                squares[entry[0]] += (entry[1]*idf)**2.0
+        self.norms = sqrt(squares)
+
+        self.maxWeight = {}
+        lengths = maximum(self.norms, 1e-12)
+        for term in self.index:
+            idf = self.computeIDF(term)
+            best = 0.0
+            for entry in self.index[term]:
+                best = max(best, entry[1]*idf/lengths[entry[0]])
+            self.maxWeight[term] = best
+
+    def computeIDF(self, term):
+        if self.statistics is not None:
+            return self.statistics[term][2]
+        df = self.index.df(term)
+        return math.log( (float(self.numberOfDocs)/df), 10 )
+
+    def queryWeights(self, terms):
+        """ Returns the weights of the query terms found in the index, and the
+        length of the query vector """
+        weights = {}
+        for term, count in vs.termCount(terms).items():
+            if term in self.index:
+                weight = count*self.computeIDF(term)
+                if weight > 0:
+                    weights[term] = weight
+        return weights, math.sqrt(sum([ w**2.0 for w in weights.values() ]))
+
+    def termAtATime(self, terms, n):
+        """ Returns the n best (docId, score), best first """
+        weights, queryLength = self.queryWeights(terms)
+        accumulators = {}
+        for term in weights:
+            wq = weights[term]*self.computeIDF(term)
+            for docId, tf in self.index[term]:
+                accumulators[docId] = accumulators.get(docId, 0.0) + wq*tf
+        scores = [ (score/(queryLength*self.norms[docId]+1), -docId) for docId, score in accumulators.items() ]
+        return [ (-docId, score) for score, docId in heapq.nlargest(n, scores) ]
+
+    def documentAtATime(self, terms, n):
+        """ Returns the n best (docId, score), best first, using MaxScore """
+        weights, queryLength = self.queryWeights(terms)
+        if not weights or n < 1:
+            return []
+
+        # Terms by increasing upper bound; bounds[i] bounds the total score
+        # the terms 0..i can add to any document
+        order = sorted(weights, key=lambda t: weights[t]*self.maxWeight[t])
+        postings = [ array(self.index[t], dtype=int64).reshape(-1, 2) for t in order ]
+        docIds = [ p[:,0] for p in postings ]
+        factors = [ weights[t]*self.computeIDF(t) for t in order ]
+        bounds = []
+        total = 0.0
+        for t in order:
+            total += weights[t]*self.maxWeight[t]/queryLength
+            bounds.append(total)
+
+        top = []            # min-heap of (score, -docId): root is the worst
+        threshold = 0.0     # A document must score more than this to enter
+        cursors = [0]*len(order)
+        essential = 0       # Terms before this one are non-essential
+
+        while True:
+            # The next candidate is the smallest docId among essential terms
+            docId = None
+            for i in range(essential, len(order)):
+                if cursors[i] < len(postings[i]):
+                    candidate = docIds[i][cursors[i]]
+                    if docId is None or candidate < docId:
+                        docId = candidate
+            if docId is None:
+                break
+
+            denominator = queryLength*self.norms[docId]+1
+            score = 0.0
+            for i in range(essential, len(order)):
+                if cursors[i] < len(postings[i]) and docIds[i][cursors[i]] == docId:
+                    score += factors[i]*postings[i][cursors[i]][1]/denominator
+                    cursors[i] += 1
+            # Non-essential terms, largest bound first, while they can matter
+            for i in range(essential-1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+                # Candidates come in docId order: the cursor only moves on
+                cursors[i] += int(docIds[i][cursors[i]:].searchsorted(docId))
+                if cursors[i] < len(postings[i]) and docIds[i][cursors[i]] == docId:
+                    score += factors[i]*postings[i][cursors[i]][1]/denominator
+
+            if len(top) < n:
+                heapq.heappush(top, (score, -docId))
+            elif score > threshold:
+                heapq.heapreplace(top, (score, -docId))
+            else:
+                continue
+            if len(top) == n:
+                threshold = top[0][0]
+                # Terms that together cannot beat the threshold stop driving
+                # the candidates
+                while essential < len(order) and bounds[essential] <= threshold:
+                    essential += 1
+
+        return [ (-docId, score) for score, docId in sorted(top, reverse=True) ]
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""SearchEngine.py
+
+Holds everything needed to answer a query in memory: the inverted index, the
+document lengths and urls, the tf-idf vectors and the k-means clusters.
+The clusters are read from index/clusters.npz (see cluster.py); k-means is
+only run here if that file is missing or older than the index.
+
+Loading is done once in the constructor, after which SearchEngine.search(query)
+only tokenises the query and ranks the documents. The engine is never modified
+after construction, so a single instance can be shared by concurrent requests
+(see searchd.py); a newer index or clustering is served by building a new
+engine.
+"""
+
+import json, threading, os.path
+import InvertedIndex as ii
+import SegmentedIndex as sg
+import Tokeniser as tk
+import WebIndexer as wi
+import VectorSpace as vs
+import SpellingCorrector as sc
+
+clustersFile = "index/clusters.npz"
+
+def stamp(filename):
+    """ Modification time of a file, None if it is missing """
+    if not os.path.exists(filename):
+        return None
+    return os.path.getmtime(filename)
+
+def toJSON(urlList):
+    """ Formats a ranked list of urls the way the web front-end expects:
+        { "1" : "url1", "2" : "url2", ... }
+    """
+    lines = [ '\t' + json.dumps(str(i+1)) + ' : ' + json.dumps(urlList[i]) for i in range(len(urlList)) ]
+    return '{\n\n' + ',\n'.join(lines) + '\n}'
+
+class SearchEngine:
+    generation = None   # Generation of the index loaded by this engine
+    files = None        # Its files, see SegmentedIndex.manifest
+    clustersStamp = None
+    index = None
+    indexer = None
+    vSpace = None
+    tokeniser = None
+    corrector = None
+
+    def __init__(self, k=8, n=10):
+        """ Loads the index from disk and builds the vectors and clusters
+        k:  number of clusters   } only used if there are no precomputed
+        n:  number of random seeds } clusters for this index generation
+        """
+        # Read the generation first: if the index is rebuilt while we load it,
+        # the generation on disk will differ and the engine will be reloaded
+        self.generation = wi.generation()
+        self.files = sg.manifest()
+        self.index = sg.openIndex()
+        self.indexer = wi.WebIndexer()
+        self.indexer.load()
+
+        vocabulary = None
+        if os.path.exists("index/vocabulary.csv"):
+            vocabulary = ii.loadVocabulary("index/vocabulary.csv")
+        self.vSpace = vs.VectorSpace(self.index, self.indexer, vocabulary)
+        self.vSpace.buildVectors()
+        # The clusters may be saved after the generation (see buildIndex.cgi):
+        # until then they are computed here, and reloaded once saved
+        self.clustersStamp = stamp(clustersFile)
+        if self.vSpace.loadClusters(clustersFile, self.generation) is None:
+            w, u, rss = self.vSpace.kMeansBestOfN(k, n)
+            self.vSpace.clusters = vs.ClusterModel(w, u, rss, k, n, None, self.generation,
+                                                   self.vSpace.numberOfRows)
+
+        if vocabulary is not None:
+            # Collection frequencies from the term statistics
+            self.corrector = sc.load("index/vocabulary.csv", "index/deletions.csv")
+        else:
+            self.corrector = sc.fromIndex(self.index)
+
+        self.tokeniser = tk.Tokeniser()
+        if vocabulary is not None:
+            self.tokeniser.stems.warm(vocabulary[0])
+        # Built (or read) now rather than on the first misspelled query, which
+        # concurrent requests would all build at once
+        self.corrector.deletionIndex()
+        # The Porter stemmer keeps its state in the instance
+        self.tokeniserLock = threading.Lock()
+
+    def isStale(self):
+        """ True if a newer index has been written to disk: a new generation,
+        the same one compacted (see WebIndexer.compact), or new clusters """
+        return wi.generation() != self.generation or sg.manifest() != self.files or \
+               stamp(clustersFile) != self.clustersStamp
+
+    def search(self, userInput, numberOfResults=10):
+        """ Returns the urls of the best numberOfResults documents """
+        self.tokeniserLock.acquire()
+        try:
+            terms = self.tokeniser.tokenise(userInput)
+        finally:
+            self.tokeniserLock.release()
+        terms = [self.corrector.correct(term) for term in terms]
+
+        closestCluster = self.vSpace.nearestCluster(None, None, self.vSpace.buildSparseQueryVector(terms))
+        queryVector = self.vSpace.buildQueryVector(terms)
+        docList = self.vSpace.topN(closestCluster, queryVector, numberOfResults)
+        return [self.indexer.urls[docId] for docId in docList]
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""SegmentedIndex.py
+
+Incremental updates of the index, log-structured: the main index
+(see BinaryIndex) is never modified by an update.
+    - new and modified pages are indexed into a small delta segment (a
+      binary index), with new docIds: larger than every docId before them
+    - deleted and modified pages are marked in a tombstone bitmap: their
+      docIds are skipped when reading the postings
+    - WebIndexer.compact merges the main index and the delta segments, minus
+      the tombstoned postings, into a new main index
+Since the docIds of a delta are larger than those of the segments before it,
+the postings of a term are the concatenation of its postings in the main
+index and in each delta, in segment order.
+
+Index files are never rewritten in place: a process may have them mapped.
+New files get new names (stamped with the generation they belong to) and
+are published together by rewriting the manifest, in a single rename.
+Readers open the files the manifest names, so they see the old set of files
+or the new one, never a mix; the files no longer used are then deleted
+(processes that have them open keep reading them until they close them).
+
+Files:
+    index/manifest      the files of the index, one per line:
+                            main BASE       the main index
+                            delta BASE      a delta segment (oldest first)
+                            tombstones FILE the tombstones, if any
+    index/deltaN, index/fullindex.N
+                        delta segments and rebuilt main indexes
+    index/fullindex.Nc  main index compacted at generation N (which a
+                        compaction does not change)
+    index/tombstones.N  number of docIds allocated so far (uint64), then one
+                        bit per docId, set if the docId is deleted (numpy
+                        packbits order)
+    index/lock          locked while the index is updated or compacted
+An index written before the manifest (index/fullindex, index/segments and
+index/tombstones) is read as if the manifest named them.
+"""
+
+import os, struct, heapq, fcntl
+from numpy import *
+import InvertedIndex as ii
+import BinaryIndex as bi
+
+mainBase = "index/fullindex"
+manifestFile = "index/manifest"
+segmentsFile = "index/segments"         # Before the manifest
+tombstonesFile = "index/tombstones"     # Before the manifest
+lockFile = "index/lock"
+attempts = 3        # Times openIndex reads the manifest if files vanish
+
+def lock():
+    """ Waits for, then holds, the lock on the index directory until the
+    returned file is closed """
+    f = open(lockFile, 'wb')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
+def replace(filename, content):
+    """ Writes a file atomically: readers see the old or the new content """
+    try:
+        f = open(filename + '.tmp', 'wb')
+        f.write(content)
+    finally:
+        f.close()
+    os.rename(filename + '.tmp', filename)
+
+def readLines(filename):
+    try:
+        f = open(filename, 'rb')
+        return [ line.strip() for line in f if line.strip() ]
+    finally:
+        f.close()
+
+def manifest():
+    """ The files of the index on disk: (main index base, delta bases oldest
+    first, tombstones file or None) """
+    if not os.path.exists(manifestFile):
+        deltas = []
+        if os.path.exists(segmentsFile):
+            deltas = readLines(segmentsFile)
+        tombstones = None
+        if os.path.exists(tombstonesFile):
+            tombstones = tombstonesFile
+        return mainBase, deltas, tombstones
+    main = mainBase
+    deltas = []
+    tombstones = None
+    for line in readLines(manifestFile):
+        kind, name = line.split(' ', 1)
+        if kind == 'main':
+            main = name
+        elif kind == 'delta':
+            deltas.append(name)
+        elif kind == 'tombstones':
+            tombstones = name
+    return main, deltas, tombstones
+
+def publish(main, deltas, tombstones=None):
+    """ Makes these files the index on disk, in one step, then deletes the
+    files of the previous index that are no longer used """
+    oldMain, oldDeltas, oldTombstones = manifest()
+    lines = [ 'main ' + main ] + [ 'delta ' + base for base in deltas ]
+    if tombstones is not None:
+        lines.append('tombstones ' + tombstones)
+    replace(manifestFile, ''.join([ line + '\n' for line in lines ]))
+    for base in [oldMain] + oldDeltas:
+        if base != main and base not in deltas:
+            bi.remove(base)
+    for filename in (oldTombstones, tombstonesFile, segmentsFile):
+        if filename is not None and filename != tombstones and os.path.exists(filename):
+            os.remove(filename)
+
+def segments():
+    """ Base names of the delta segments, oldest first """
+    return manifest()[1]
+
+def newSegment(stamp):
+    """ Base name for a new delta segment of generation stamp """
+    return "index/delta" + stamp
+
+def loadTombstones(filename=None):
+    """ Boolean array, True for deleted docIds; its length is the number of
+    docIds allocated so far (empty if there are no tombstones)
+    filename: tombstones file, the one of the manifest if None """
+    if filename is None:
+        filename = manifest()[2]
+    if filename is None:
+        return zeros(0, dtype=bool)
+    try:
+        f = open(filename, 'rb')
+        count, = struct.unpack('<Q', f.read(8))
+        bits = frombuffer(f.read(), dtype=uint8)
+    finally:
+        f.close()
+    return unpackbits(bits)[:count].astype(bool)
+
+def saveTombstones(dead, stamp):
+    """ Saves tombstones for generation stamp; returns the file name, to
+    publish """
+    filename = "index/tombstones." + stamp
+    replace(filename, struct.pack('<Q', len(dead)) + packbits(dead.astype(uint8)).tostring())
+    return filename
+
+def isSegmented():
+    """ True if the index on disk has deltas or deletions to apply """
+    main, deltas, tombstones = manifest()
+    return bool(deltas) or loadTombstones(tombstones).any()
+
+def openIndex():
+    """ The index on disk, with the interface of InvertedIndex: a
+    SegmentedIndex if there are pending updates, else the main index
+    (mapped if it was saved in the binary format).
+    The files are those of the manifest; if they are replaced while being
+    opened, the new manifest is read. """
+    for attempt in range(attempts):
+        main, deltas, tombstones = manifest()
+        try:
+            dead = loadTombstones(tombstones)
+            if deltas or dead.any():
+                return SegmentedIndex(main, deltas, dead)
+            if bi.exists(main):
+                # Mapped, nothing to parse
+                return bi.MappedIndex(main)
+            index = ii.InvertedIndex()
+            ii.load(mainBase + ".csv", index)
+            return index
+        except (IOError, OSError):
+            if attempt == attempts-1 or manifest() == (main, deltas, tombstones):
+                raise
+
+def alive(docIds, dead):
+    """ Mask of the docIds that are not tombstoned """
+    mask = ones(len(docIds), dtype=bool)
+    inside = docIds < len(dead)
+    mask[inside] = ~dead[docIds[inside]]
+    return mask
+
+class SegmentedIndex:
+    """ Read only view of the main index, the deltas and the tombstones, with
+    the interface of InvertedIndex. Postings are returned as (df, 2) arrays
+    as in MappedIndex.
+    Opening it reads the term dictionaries of every segment; if there are
+    tombstones, the postings are also decoded once to count the live
+    documents of each term (terms left without any are dropped).
+    """
+
+    def __init__(self, base=None, deltas=None, dead=None):
+        """ base, deltas, dead: the main index, delta segments and tombstones,
+        those of the manifest if None """
+        main, current, tombstones = manifest()
+        if base is None:
+            base = main
+        if deltas is None:
+            deltas = current
+        if dead is None:
+            dead = loadTombstones(tombstones)
+        self.dead = dead
+        self.anyDead = bool(dead.any())
+        bases = deltas
+        if bi.exists(base):
+            bases = [base] + deltas
+        self.segments = [ bi.MappedIndex(b) for b in bases ]
+        self.terms = []         # Sorted live terms
+        self.locations = {}     # Maps each term to its (segment, position)s
+        self.dfs = {}           # Maps each term to its live df
+        streams = [ bi.termStream(self.segments[j], j) for j in range(len(self.segments)) ]
+        for term, j, i in heapq.merge(*streams):
+            if term not in self.locations:
+                self.locations[term] = []
+                self.dfs[term] = 0
+            self.locations[term].append( (j, i) )
+            if self.anyDead:
+                self.dfs[term] += int(alive(self.segments[j].postingsAt(i)[:,0], self.dead).sum())
+            else:
+                self.dfs[term] += int(self.segments[j].dfs[i])
+        for term in sorted(self.locations):
+            if self.dfs[term] > 0:
+                self.terms.append(term)
+            else:
+                del self.locations[term]
+                del self.dfs[term]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def keys(self):
+        return list(self.terms)
+
+    def __contains__(self, term):
+        return bi.encodeTerm(term) in self.dfs
+
+    def __getitem__(self, term):
+        parts = [ self.segments[j].postingsAt(i) for j, i in self.locations[bi.encodeTerm(term)] ]
+        postings = concatenate(parts)
+        if self.anyDead:
+            postings = postings[alive(postings[:,0], self.dead)]
+        return postings
+
+    def tf(self, term, docId):
+        """ Return the term frequency for a given term and docId """
+        if term not in self or not alive(array([docId]), self.dead)[0]:
+            return 0
+        for j, i in self.locations[bi.encodeTerm(term)]:
+            tf = self.segments[j].tf(term, docId)
+            if tf:
+                return tf
+        return 0
+
+    def df(self, term):
+        """ Return the document frequency for a given term """
+        return self.dfs.get(bi.encodeTerm(term), 0)
+
+    def totalFreq(self, term):
+        return int(self[term][:,1].sum())
+
+    def frequencies(self):
+        index = {}
+        for term in self.terms:
+            index[term] = self.totalFreq(term)
+        return index
+
+    def statistics(self):
+        """ Maps each term to its (df, cf, max tf), see
+        InvertedIndex.writeVocabulary """
+        stats = {}
+        for term in self.terms:
+            tfs = self[term][:,1]
+            stats[term] = (len(tfs), int(tfs.sum()), int(tfs.max()))
+        return stats
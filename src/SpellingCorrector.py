@@ -1,26 +1,161 @@
-import re, collections
+"""SpellingCorrector.py
+
+Corrects query terms to the most frequent term of the index within edit
+distance 2 (insertions, deletions, replacements and transpositions).
+
+Candidates are found with a deletion index (SymSpell): every term is stored
+under each string obtained by deleting at most 2 of its letters. Two words
+within distance 2 of each other share such a deletion, so the candidates for
+a word are the terms stored under its own deletions: a few hundred dictionary
+lookups instead of generating every possible edit of the word.
+
+A SpellingCorrector is made from the frequencies of the terms: taken from an
+index already in memory (fromIndex), or read from the term statistics saved
+when the index is built (load, see InvertedIndex.saveVocabulary). Nothing
+is loaded when the module is imported, and the deletion index is built on
+the first correction unless deletionIndex is called beforehand (SearchEngine
+does, so that no request builds it); with load, it is saved next to the
+frequencies and read from there until the index is rebuilt.
+"""
+
+import csv, os.path
 import InvertedIndex as ii
 
-index = ii.InvertedIndex()
-ii.load("index/fullindex.csv", index)
+maxDistance = 2
+
+def deletes(word, distance=maxDistance):
+    """ The strings obtained by deleting at most distance letters of word
+    (word included) """
+    result = set([word])
+    edges = [word]
+    for i in range(distance):
+        edges = [ w[:j] + w[j+1:] for w in edges for j in range(len(w)) ]
+        result.update(edges)
+    return result
+
+def buildDeletions(words):
+    result = {}
+    for word in words:
+        for deletion in deletes(word):
+            result.setdefault(deletion, []).append(word)
+    return result
+
+def saveDeletions(savefile, deletions):
+    """ Written to a temporary file renamed over savefile, so that it is
+    never read half written """
+    try:
+        f = open(savefile+'.tmp', 'wb')
+        fields = ('deletion', 'terms')
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writerow(dict((n,n) for n in fields))
+        for deletion in sorted(deletions):
+            writer.writerow( { fields[0]:deletion,
+                               fields[1]:' '.join(deletions[deletion]) } )
+    finally:
+        f.close()
+    os.rename(savefile+'.tmp', savefile)
+
+def loadDeletions(loadfile):
+    result = {}
+    try:
+        f = open(loadfile, 'rb')
+        reader = csv.DictReader(f)
+        for row in reader:
+            result[row['deletion']] = row['terms'].split(' ')
+    finally:
+        f.close()
+    return result
+
+def distance(a, b):
+    """ Damerau-Levenshtein distance: the fewest insertions, deletions,
+    replacements and transpositions of adjacent letters turning a into b
+    (a transposed pair may be edited again, as with edits of edits) """
+    infinity = len(a) + len(b)
+    d = [ [infinity]*(len(b)+2) for i in range(len(a)+2) ]
+    for i in range(len(a)+1):
+        d[i+1][1] = i
+    for j in range(len(b)+1):
+        d[1][j+1] = j
+    last = {}           # Last row where each letter of a was seen
+    for i in range(1, len(a)+1):
+        lastColumn = 0  # Last column of this row where the letters matched
+        for j in range(1, len(b)+1):
+            k = last.get(b[j-1], 0)
+            l = lastColumn
+            cost = 1
+            if a[i-1] == b[j-1]:
+                cost = 0
+                lastColumn = j
+            d[i+1][j+1] = min(d[i][j] + cost, d[i+1][j] + 1, d[i][j+1] + 1,
+                              d[k][l] + (i-k-1) + 1 + (j-l-1))
+        last[a[i-1]] = i
+    return d[len(a)+1][len(b)+1]
 
-NWORDS = index.frequencies()
+def fromIndex(index):
+    """ SpellingCorrector of an index in memory (InvertedIndex, MappedIndex
+    or SegmentedIndex) """
+    return SpellingCorrector(index.frequencies())
 
-alphabet = 'abcdefghijklmnopqrstuvwxyz'
+def load(loadfile, deletionsFile=None):
+    """ SpellingCorrector of the collection frequencies of a vocabulary
+    saved with InvertedIndex.saveVocabulary
+    deletionsFile: where to keep its deletion index, rebuilt if older than
+                   loadfile
+    """
+    frequencies = {}
+    for term, stats in ii.loadStatistics(loadfile).items():
+        frequencies[term] = stats[1]
+    corrector = SpellingCorrector(frequencies, deletionsFile)
+    corrector.since = os.path.getmtime(loadfile)
+    return corrector
 
-def edits1(word):
-   splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-   deletes    = [a + b[1:] for a, b in splits if b]
-   transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1]
-   replaces   = [a + c + b[1:] for a, b in splits for c in alphabet if b]
-   inserts    = [a + c + b     for a, b in splits for c in alphabet]
-   return set(deletes + transposes + replaces + inserts)
+class SpellingCorrector:
+    frequencies = None  # Maps each term to its frequency in the index
+    deletions = None    # Maps each deletion to the terms it comes from
+    deletionsFile = None
+    since = None        # Deletion indexes saved before this time are stale
 
-def known_edits2(word):
-    return set(e2 for e1 in edits1(word) for e2 in edits1(e1) if e2 in NWORDS)
+    def __init__(self, frequencies, deletionsFile=None):
+        """ SpellingCorrector
+        frequencies:    maps each term to its frequency
+        deletionsFile:  where to save the deletion index and read it from
+                        (only if it is newer than since)
+        """
+        self.frequencies = frequencies
+        self.deletionsFile = deletionsFile
+        self.deletions = None
 
-def known(words): return set(w for w in words if w in NWORDS)
+    def deletionIndex(self):
+        """ The deletion index of the terms, read from deletionsFile unless
+        it is stale, else built (and saved) """
+        if self.deletions is None:
+            if self.deletionsFile is None:
+                self.deletions = buildDeletions(self.frequencies)
+            elif self.since is not None and \
+                 os.path.exists(self.deletionsFile) and \
+                 os.path.getmtime(self.deletionsFile) >= self.since:
+                self.deletions = loadDeletions(self.deletionsFile)
+            else:
+                self.deletions = buildDeletions(self.frequencies)
+                saveDeletions(self.deletionsFile, self.deletions)
+        return self.deletions
 
-def correct(word):
-    candidates = known([word]) or known(edits1(word)) or known_edits2(word) or [word]
-    return max(candidates, key=NWORDS.get)
+    def correct(self, word):
+        """ word if it is in the index, else the closest term (most frequent
+        first), else word """
+        if word in self.frequencies:
+            return word
+        index = self.deletionIndex()
+        candidates = set()
+        for deletion in deletes(word):
+            candidates.update(index.get(deletion, ()))
+        best = None
+        for term in candidates:
+            d = distance(word, term)
+            if d <= maxDistance:
+                key = (d, -self.frequencies[term], term)
+                if best is None or key < best:
+                    best = key
+        if best is None:
+            return word
+        return best[2]
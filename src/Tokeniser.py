@@ -9,7 +9,13 @@ Performs the following lossy compression on the dictionary:
     - Stemming
     - Stop word removal
 
-Tokeniser.tokenise(string) parses string and returns a list of tokens.
+Tokeniser.tokenise(string) parses string and returns a list of tokens,
+Tokeniser.iterTokens(string) yields them one at a time and
+Tokeniser.tokeniseMany(strings) tokenises a batch of strings.
+Each term is case folded, filtered and stemmed in a single pass.
+
+Stems are memoized in a bounded StemCache: the same words come back in every
+document and query, and the Porter stemmer is slow.
 
 Class structure inspired by:
     http://blog.josephwilk.net/projects/
@@ -19,68 +25,127 @@ Class structure inspired by:
 import re
 import PorterStemmer as ps
 
+regexTerm       = re.compile(r'\b[a-zA-Z]+\b')
+regexAlphaNum   = re.compile(r'\b[a-zA-Z0-9]+\b')
+
+class StemCache:
+    """ Memoizes the stems of at most size words.
+    Words are kept in two generations of size/2: when the newer one is full
+    it becomes the older one, and the older one is dropped. A word found in
+    the older generation moves to the newer, so the words in use stay cached
+    (an approximate LRU, at the cost of a dictionary lookup).
+    """
+    stemmer = None
+    size = 0
+    hits = 0            # Words found in the cache
+    misses = 0          # Words stemmed
+
+    def __init__(self, stemmer, size=50000):
+        self.stemmer = stemmer
+        self.size = max(size, 2)
+        self.newer = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.newer) + len(self.older)
+
+    def stem(self, word):
+        stem = self.newer.get(word)
+        if stem is not None:
+            self.hits += 1
+            return stem
+        stem = self.older.get(word)
+        if stem is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            stem = self.stemmer.stem(word, 0, len(word)-1)
+        if len(self.newer) >= self.size // 2:
+            self.older = self.newer
+            self.newer = {}
+        self.newer[word] = stem
+        return stem
+
+    def warm(self, words):
+        """ Stems words ahead of time (e.g. the vocabulary of the index: most
+        stems are words too); does not count as hits or misses """
+        hits, misses = self.hits, self.misses
+        for word in words:
+            self.stem(word)
+        self.hits, self.misses = hits, misses
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
 class Tokeniser:
     numberFilter = True
     caseFolding  = True
-    stopWords = []
+    regexTerm = regexTerm
+    stopWords = frozenset()
     stemmer = None
+    stems = None        # StemCache of the stemmer, None if stemming is off
     
     def __init__(self, stopList='cornell.stop',
                  useNumberFilter=True, useCaseFolding=True,
-                 useStopList=True, useStemming=True):
+                 useStopList=True, useStemming=True, cacheSize=50000):
         """ Tokeniser constructor
         Optionally specify a stopword list:
             - 'google.stop' : 61  words
               (From Google's search stop words, plus single letters)
             - 'cornell.stop': 572 words
               (From ftp://ftp.cs.cornell.edu/pub/smart/english.stop)
+        cacheSize: number of words whose stem is remembered
         """
         self.numberFilter = useNumberFilter
         self.caseFolding  = useCaseFolding
+        # Number Filtering
+        if self.numberFilter:
+            self.regexTerm = regexTerm
+        else:
+            self.regexTerm = regexAlphaNum
         if useStopList:
             try:
                 f = open(stopList, 'rb')
-                self.stopWords = sorted( f.read().split() )
+                self.stopWords = frozenset( f.read().split() )
             finally:
                 f.close()
         if useStemming:
             self.stemmer = ps.PorterStemmer()
+            self.stems = StemCache(self.stemmer, cacheSize)
         
-    def filterStopWords(self, term, lo=0, hi=None):
-        """ binary search used to filter stopwords """
-        if hi is None:
-            hi = len(self.stopWords)
-        while lo < hi:
-            mid = (lo+hi)//2
-            midval = self.stopWords[mid]
-            if midval < term:
-                lo = mid+1
-            elif midval > term:
-                hi = mid
-            else:
-                return False
-        return True
+    def filterStopWords(self, term):
+        """ False for stop words """
+        return term not in self.stopWords
 
     def tokenise(self, string):
         """ Find all terms, case fold, remove stop words, and stem """
-        regexTerm = None
-
-        # Number Filtering
-        if self.numberFilter:
-            regexTerm = re.compile(r'\b[a-zA-Z]+\b')
-        else:
-            regexTerm = re.compile(r'\b[a-zA-Z0-9]+\b')
-        terms = regexTerm.findall(string)
-
-        # Case Folding
+        terms = self.regexTerm.findall(string)
         if self.caseFolding:
-            terms = [term.lower() for term in terms]
-
-        # Stop word removal
-        terms = filter(self.filterStopWords, terms)
+            terms = ( term.lower() for term in terms )
+        stopWords = self.stopWords
+        if self.stems is None:
+            return [ term for term in terms if term not in stopWords ]
+        stem = self.stems.stem
+        return [ stem(term) for term in terms if term not in stopWords ]
 
-        # Stemming
-        if self.stemmer is not None:
-            terms = [ self.stemmer.stem(term, 0, len(term)-1) for term in terms ]
+    def iterTokens(self, string):
+        """ Yields the tokens of string one at a time (see tokenise) """
+        stopWords = self.stopWords
+        for match in self.regexTerm.finditer(string):
+            term = match.group()
+            if self.caseFolding:
+                term = term.lower()
+            if term in stopWords:
+                continue
+            if self.stems is not None:
+                term = self.stems.stem(term)
+            yield term
 
-        return terms
+    def tokeniseMany(self, strings):
+        """ List of the tokens of each string """
+        return [ self.tokenise(string) for string in strings ]
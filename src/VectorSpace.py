@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 from numpy import * #http://www.lfd.uci.edu/~gohlke/pythonlibs/#numpy
-import math, random
+import math, random, os, itertools, multiprocessing, pickle, tempfile, shutil
 import InvertedIndex as ii
 import WebIndexer as wi
 
 L = 10
+clusterBoost = 1.2  # Weight of documents in the cluster nearest to the query
 
 def vectorLength(v):
     return (sum(v**2.0))**0.5
@@ -25,63 +26,515 @@ def termCount(terms):
             termDict[term] += 1
     return termDict
 
+class SparseMatrix:
+    """ Compressed sparse row (CSR) matrix of document vectors.
+    Only the non-zero tf-idf weights are stored:
+        data[indptr[d]:indptr[d+1]]     weights of document d
+        indices[indptr[d]:indptr[d+1]]  columns (terms) of those weights
+    Indexing a row (matrix[docId]) returns it as a dense vector, like the
+    dense array it replaces.
+    """
+    shape = (0, 0)
+    data = None
+    indices = None
+    indptr = None
+    rowOf = None        # Row of each stored weight
+
+    def __init__(self, rows, columns, weights, shape, ordered=False):
+        """ Builds the matrix from (rows[i], columns[i]) = weights[i] entries
+        ordered: the entries are already sorted by row, then column """
+        self.shape = shape
+        self.data = asarray(weights, dtype=float64)
+        self.indices = asarray(columns, dtype=int32)
+        self.rowOf = asarray(rows, dtype=int32)
+        if not ordered:
+            order = lexsort((columns, rows))
+            self.data = self.data[order]
+            self.indices = self.indices[order]
+            self.rowOf = self.rowOf[order]
+        self.indptr = zeros(shape[0]+1, dtype=int64)
+        cumsum(bincount(self.rowOf, minlength=shape[0]), out=self.indptr[1:])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, row):
+        lo, hi = self.indptr[row], self.indptr[row+1]
+        v = zeros(self.shape[1])
+        v[self.indices[lo:hi]] = self.data[lo:hi]
+        return v
+
+    def rowLength(self, row):
+        lo, hi = self.indptr[row], self.indptr[row+1]
+        return vectorLength(self.data[lo:hi])
+
+    def rowLengths(self):
+        """ Length of every row, as an array """
+        return sqrt(bincount(self.rowOf, weights=self.data**2.0, minlength=self.shape[0]))
+
+    def addRow(self, v, row):
+        """ v += matrix[row], without building the dense row """
+        lo, hi = self.indptr[row], self.indptr[row+1]
+        v[self.indices[lo:hi]] += self.data[lo:hi]
+
+    def dot(self, vector):
+        """ Matrix-vector product: dot(matrix[d], vector) for every row d """
+        return bincount(self.rowOf, weights=self.data*vector[self.indices], minlength=self.shape[0])
+
+    def dotRows(self, vectors):
+        """ dot(matrix[d], vectors[j]) for every row d and vector j, as a
+        (rows, vectors) array """
+        result = zeros( (self.shape[0], len(vectors)) )
+        for j in range(len(vectors)):
+            result[:,j] = self.dot(vectors[j])
+        return result
+
+    def dotEach(self, vectors, which):
+        """ dot(matrix[d], vectors[which[d]]) for every row d """
+        cells = asarray(which, dtype=int64)[self.rowOf]*vectors.shape[1] + self.indices
+        return bincount(self.rowOf, weights=self.data*take(vectors, cells), minlength=self.shape[0])
+
+    def rows(self, rows):
+        """ SparseMatrix of some rows only: row i is row rows[i] of this one.
+        Only those rows are read (a mapped matrix is not read whole). """
+        rows = asarray(rows, dtype=int64)
+        lo = asarray(self.indptr[rows], dtype=int64)
+        lengths = asarray(self.indptr[rows+1], dtype=int64) - lo
+        starts = cumsum(lengths) - lengths
+        positions = arange(lengths.sum()) + repeat(lo - starts, lengths)
+        return SparseMatrix(repeat(arange(len(rows)), lengths), self.indices[positions],
+                            self.data[positions], (len(rows), self.shape[1]), True)
+
+    def sumRows(self, groups, numberOfGroups):
+        """ Sum of the rows of each group: groups gives the group of every row
+        (-1 for none); returns a (numberOfGroups, columns) array """
+        groupOf = asarray(groups)[self.rowOf]
+        keep = groupOf >= 0
+        cells = groupOf[keep].astype(int64)*self.shape[1] + self.indices[keep]
+        sums = bincount(cells, weights=self.data[keep], minlength=numberOfGroups*self.shape[1])
+        return sums.reshape(numberOfGroups, self.shape[1])
+
+def buildMatrix(index, columns, idf, numberOfRows):
+    """ Builds the tf-idf SparseMatrix straight from the postings lists
+    columns:        maps each term to its column
+    idf:            idf of each column
+    numberOfRows:   largest docId + 1
+    """
+    # df comes from the term table, so each postings list is decoded once
+    nnz = 0
+    for term in index:
+        nnz += index.df(term)
+    rows = zeros(nnz, dtype=int32)
+    cols = zeros(nnz, dtype=int32)
+    weights = zeros(nnz)
+    pos = 0
+    for term in index:
+        postings = index[term]
+        end = pos + len(postings)
+        entries = array(postings, dtype=int64).reshape(-1, 2)
+        rows[pos:end] = entries[:,0]
+        cols[pos:end] = columns[term]
+        weights[pos:end] = entries[:,1] * idf[columns[term]]
+        pos = end
+    return SparseMatrix(rows, cols, weights, (numberOfRows, len(columns)))
+
+class ClusterModel:
+    """ A k-means clustering computed offline (see cluster.py) and saved with
+    the index, so that queries do not have to run k-means.
+    The file records how to reproduce it (k, n restarts, seed) and the index
+    generation it was computed from.
+    """
+    k = 0
+    n = 0
+    seed = 0
+    rss = 0.0
+    generation = None
+    centroids = None    # k x numberOfTerms array
+    assignments = None  # Cluster of each docId (-1 if the docId is unused)
+    w = None            # List of k clusters (lists of docIds)
+    centroidNorms = None # Squared length of each centroid
+
+    def __init__(self, w, u, rss, k, n, seed, generation, numberOfDocs):
+        self.w = w
+        self.k = k
+        self.n = n
+        self.seed = seed
+        self.rss = rss
+        self.generation = generation
+        self.centroids = array(u)
+        self.centroidNorms = sum(self.centroids**2.0, axis=1)
+        self.assignments = -ones(numberOfDocs, dtype=int32)
+        for i in range(len(w)):
+            for docId in w[i]:
+                self.assignments[docId] = i
+
+    def save(self, savefile):
+        """ Saves the clustering as a numpy .npz archive """
+        f = open(savefile, 'wb')
+        try:
+            savez(f, centroids=self.centroids, assignments=self.assignments,
+                  params=array([self.k, self.n, self.seed]), rss=array(self.rss),
+                  generation=array(self.generation))
+        finally:
+            f.close()
+
+def loadClusters(loadfile):
+    """ Loads a ClusterModel saved with ClusterModel.save """
+    data = load(loadfile)
+    try:
+        assignments = data['assignments']
+        k, n, seed = [int(i) for i in data['params']]
+        w = [ [] for i in range(k) ]
+        for docId in flatnonzero(assignments >= 0):
+            w[assignments[docId]].append(int(docId))
+        return ClusterModel(w, data['centroids'], float(data['rss']), k, n, seed,
+                            str(data['generation']), len(assignments))
+    finally:
+        data.close()
+
+def centroids(matrix, assignments, k):
+    """ Mean of the rows of each cluster, from the cluster of every row (-1
+    for unused docIds), as a (k, columns) array.
+    Returns the centroids and the size of each cluster; the centroid of an
+    empty cluster is 0. """
+    sizes = bincount(assignments[assignments >= 0], minlength=k)
+    u = matrix.sumRows(assignments, k)
+    u /= maximum(sizes, 1)[:,newaxis]
+    return u, sizes
+
+def squaredDistances(matrix, norms, u, sizes):
+    """ |x-u|^2 = |x|^2 - 2x.u + |u|^2 from every row to every centroid, as
+    a (rows, k) array; empty clusters are infinitely far """
+    d = (norms**2.0)[:,newaxis] - 2.0*matrix.dotRows(u) + sum(u**2.0, axis=1)
+    d = maximum(d, 0.0)     # Rounding errors
+    d[:, sizes == 0] = inf
+    return d
+
+def ownSquaredDistances(matrix, norms, u, assignments):
+    """ Squared distance from every row to the centroid of its own cluster:
+    the same values as squaredDistances, for one centroid per row """
+    clusterOf = maximum(assignments, 0)
+    d = norms**2.0 - 2.0*matrix.dotEach(u, clusterOf) + sum(u**2.0, axis=1)[clusterOf]
+    return maximum(d, 0.0)
+
+def plusPlus(matrix, norms, docIds, k, rng):
+    """ k-means++ seeding: k of the docIds, the first one at random, then each
+    with a probability proportional to its squared distance to the nearest
+    one already chosen """
+    squares = norms[docIds]**2.0
+    seeds = [ docIds[rng.randrange(len(docIds))] ]
+    nearest = None
+    while len(seeds) < k:
+        c = matrix[seeds[-1]]
+        d = maximum(squares - 2.0*matrix.dot(c)[docIds] + sum(c**2.0), 0.0)
+        nearest = d if nearest is None else minimum(nearest, d)
+        total = nearest.sum()
+        if total > 0:
+            i = searchsorted(cumsum(nearest), rng.random()*total, side='right')
+            seeds.append(docIds[min(i, len(docIds)-1)])
+        else:
+            seeds.append(docIds[rng.randrange(len(docIds))])
+    return seeds
+
+def kMeans(matrix, norms, docIds, k, seed=None, init='random', tolerance=0.0,
+           maxIterations=100, batchSize=None, pruning=False):
+    """ k-means clustering of the rows docIds of a SparseMatrix, whose
+    lengths are norms.
+    init:           'random': each document starts in a random class (drawn
+                    in the order of docIds, with seed); 'kmeans++': in the
+                    class of the nearest of k seeds chosen by plusPlus
+    tolerance:      stops once the RSS changes by at most this fraction of
+                    itself (0: once it stops changing)
+    maxIterations:  stops after this many iterations anyway (None: never)
+    batchSize:      runs miniBatchKMeans with batches of this many documents
+    pruning:        runs the iterations with prunedKMeans (same result)
+    Each iteration computes the distances from every document to every
+    centroid at once; they give the RSS of the current clusters and the
+    nearest centroid of each document for the next ones.
+    Returns the clusters (lists of docIds), the centroids and the RSS. """
+    if batchSize is not None:
+        return miniBatchKMeans(matrix, norms, docIds, k, batchSize, seed, init, tolerance, maxIterations)
+    docIds = array(docIds, dtype=int64)
+    rows = arange(len(docIds))
+    # Initial seed and centroid
+    rng = random.Random(seed)
+    assignments = -ones(matrix.shape[0], dtype=int64)
+    if init == 'kmeans++':
+        u = array([ matrix[docId] for docId in plusPlus(matrix, norms, docIds, k, rng) ])
+        assignments[docIds] = squaredDistances(matrix, norms, u, ones(k))[docIds].argmin(axis=1)
+    else:
+        for docId in docIds:
+            assignments[docId] = rng.randrange(0,k)
+    if pruning:
+        return prunedKMeans(matrix, norms, docIds, assignments, k, tolerance, maxIterations)
+    u, sizes = centroids(matrix, assignments, k)
+    d = squaredDistances(matrix, norms, u, sizes)[docIds]
+    thisRSS = d[rows, assignments[docIds]].sum()
+    prevRSS = 0
+    iterations = 0
+    while abs(thisRSS - prevRSS) > tolerance*thisRSS and \
+          (maxIterations is None or iterations < maxIterations):
+        # Set each doc to the class with the nearest centroid
+        assignments[docIds] = d.argmin(axis=1)
+        # Calculate the new centroids and RSS
+        u, sizes = centroids(matrix, assignments, k)
+        d = squaredDistances(matrix, norms, u, sizes)[docIds]
+        prevRSS = thisRSS
+        thisRSS = d[rows, assignments[docIds]].sum()
+        iterations += 1
+    w = [ docIds[assignments[docIds] == i].tolist() for i in range(k) ]
+    return w, list(u), float(thisRSS)
+
+def prunedKMeans(matrix, norms, docIds, assignments, k, tolerance=0.0, maxIterations=100):
+    """ The iterations of kMeans from the given assignments, skipping the
+    distances that cannot change them (Elkan, 2003). Every document keeps
+    its distance to its own centroid (exact: the RSS needs it anyway) and a
+    lower bound on its distance to each centroid, lowered by how far that
+    centroid moves. By the triangle inequality, a centroid cannot be nearer
+    than the document's own if its bound is larger than the own distance, or
+    if the two centroids are more than twice that distance apart. Only the
+    distances from documents to the centroids left are computed, in one
+    pass; while that is more than a quarter of them (the first iterations),
+    all the distances are computed at once as in kMeans, which is faster.
+    The bounds allow for rounding errors, so the clusters, centroids and
+    RSS are exactly those of kMeans. """
+    rows = arange(len(docIds))
+    u, sizes = centroids(matrix, assignments, k)
+    d = squaredDistances(matrix, norms, u, sizes)[docIds]
+    thisRSS = d[rows, assignments[docIds]].sum()
+    prevRSS = 0
+    iterations = 0
+    upper = None        # Distance of each document to its centroid
+    lower = sqrt(d)     # Lower bounds of its distance to each centroid
+    squares = norms[docIds]**2.0
+    while abs(thisRSS - prevRSS) > tolerance*thisRSS and \
+          (maxIterations is None or iterations < maxIterations):
+        # Set each doc to the class with the nearest centroid
+        if upper is not None:
+            current = assignments[docIds]
+            uu = sum(u**2.0, axis=1)
+            between = sqrt(maximum(uu[:,newaxis] - 2.0*dot(u, u.T) + uu, 0.0))
+            between[arange(k), arange(k)] = inf
+            # Distances are rounded: bounds must beat them by more than that
+            reach = (upper + 4.0*sqrt(1e-10*(squares + uu.max())))[:,newaxis]
+            candidates = (reach >= lower) & (reach >= 0.5*between[current]) & (sizes > 0)
+            candidates[rows, current] = False
+            docs, others = nonzero(candidates)
+            if len(docs) > len(docIds)*k/4:
+                d = squaredDistances(matrix, norms, u, sizes)[docIds]
+                lower = sqrt(d)
+            else:
+                d = inf*ones( (len(docIds), k) )
+                d[rows, current] = own
+                if len(docs):
+                    some = docIds[docs]
+                    products = matrix.rows(some).dotEach(u, others)
+                    d[docs, others] = maximum(norms[some]**2.0 - 2.0*products + uu[others], 0.0)
+                    lower[docs, others] = sqrt(d[docs, others])
+        nearest = d.argmin(axis=1)
+        assignments[docIds] = nearest
+        # Calculate the new centroids and RSS
+        previous = u
+        u, sizes = centroids(matrix, assignments, k)
+        drift = sqrt(sum((u - previous)**2.0, axis=1))
+        lower -= drift
+        own = ownSquaredDistances(matrix, norms, u, assignments)[docIds]
+        upper = sqrt(own)
+        lower[rows, nearest] = upper
+        prevRSS = thisRSS
+        thisRSS = own.sum()
+        iterations += 1
+    w = [ docIds[assignments[docIds] == i].tolist() for i in range(k) ]
+    return w, list(u), float(thisRSS)
+
+def miniBatchKMeans(matrix, norms, docIds, k, batchSize, seed=None, init='random',
+                    tolerance=0.0, maxIterations=100):
+    """ Mini-batch k-means (Sculley, 2010): each iteration reads batchSize
+    random documents only, assigns them to their nearest centroid and moves
+    each centroid towards them; a centroid is the mean of every document
+    assigned to it so far. Only a sample of 3*batchSize documents is read
+    to choose the k starting centroids (k random ones, or with plusPlus).
+    Stops after maxIterations batches (None: 100), or once the centroids
+    move by at most tolerance times their squared length.
+    The clusters and the RSS come from a last pass, batch by batch, over
+    all the documents. Returns the same as kMeans. """
+    docIds = array(docIds, dtype=int64)
+    if k > len(docIds):
+        raise ValueError("More clusters than documents")
+    if maxIterations is None:
+        maxIterations = 100
+    rng = random.Random(seed)
+    sample = docIds[sorted(rng.sample(xrange(len(docIds)), min(len(docIds), max(3*batchSize, k))))]
+    sampleRows = matrix.rows(sample)
+    if init == 'kmeans++':
+        first = plusPlus(sampleRows, norms[sample], arange(len(sample)), k, rng)
+    else:
+        first = rng.sample(xrange(len(sample)), k)
+    u = array([ sampleRows[i] for i in first ])
+    counts = zeros(k)       # Documents assigned to each centroid so far
+    for iteration in range(maxIterations):
+        batch = docIds[rng.sample(xrange(len(docIds)), min(batchSize, len(docIds)))]
+        batchRows = matrix.rows(batch)
+        nearest = squaredDistances(batchRows, norms[batch], u, ones(k)).argmin(axis=1)
+        sizes = bincount(nearest, minlength=k)
+        counts += sizes
+        moved = sizes > 0
+        # Running mean: u += (sum of the new documents - sizes*u) / counts
+        step = (batchRows.sumRows(nearest, k)[moved] - sizes[moved][:,newaxis]*u[moved]) / counts[moved][:,newaxis]
+        u[moved] += step
+        if sum(step**2.0) <= tolerance*sum(u**2.0):
+            break
+    assignments = zeros(len(docIds), dtype=int64)
+    rss = 0.0
+    for start in range(0, len(docIds), batchSize):
+        batch = docIds[start:start+batchSize]
+        d = squaredDistances(matrix.rows(batch), norms[batch], u, ones(k))
+        assignments[start:start+len(batch)] = d.argmin(axis=1)
+        rss += d.min(axis=1).sum()
+    w = [ docIds[assignments == i].tolist() for i in range(k) ]
+    return w, list(u), float(rss)
+
+# Parallel k-means: the workers map the document vectors from .npy files
+# instead of receiving a pickled copy with every task. Every run saves them
+# in a folder of its own, removed once its pool is done, so a file mapped by
+# a worker is never rewritten under it.
+
+def saveVectors(base, matrix, norms, docIds):
+    """ Saves a SparseMatrix, the lengths of its rows and the docIds to
+    cluster (in order) as .npy files in the folder base """
+    if not os.path.isdir(base):
+        os.makedirs(base)
+    arrays = { 'data':matrix.data, 'indices':matrix.indices, 'rowOf':matrix.rowOf,
+               'indptr':matrix.indptr, 'shape':array(matrix.shape, dtype=int64),
+               'norms':norms, 'docIds':array(docIds, dtype=int64) }
+    for name in arrays:
+        save(os.path.join(base, name + '.npy'), arrays[name])
+
+def loadVectors(base):
+    """ (matrix, norms, docIds) saved by saveVectors, mapped read only """
+    def mapped(name):
+        return load(os.path.join(base, name + '.npy'), mmap_mode='r')
+    shape = tuple( int(i) for i in mapped('shape') )
+    matrix = SparseMatrix(zeros(0), zeros(0), zeros(0), shape)
+    matrix.data = mapped('data')
+    matrix.indices = mapped('indices')
+    matrix.rowOf = mapped('rowOf')
+    matrix.indptr = mapped('indptr')
+    return matrix, mapped('norms'), mapped('docIds')
+
+def kMeansTask(task):
+    """ One k-means restart in a worker process; options are the keyword
+    arguments of kMeans """
+    base, k, seed, options = task
+    matrix, norms, docIds = loadVectors(base)
+    return kMeans(matrix, norms, docIds, k, seed, **options)
+
+def kMeansRSS(task):
+    return kMeansTask(task)[2]
+
+def loadSweep(loadfile, generation=None, options={}):
+    """ RSS of each k saved by saveSweep; empty if the file is missing or
+    was made from another index generation or with other kMeans options """
+    if not os.path.exists(loadfile):
+        return {}
+    f = open(loadfile, 'rb')
+    try:
+        cache = pickle.load(f)
+    finally:
+        f.close()
+    if not isinstance(cache, dict) or cache.get('generation') != generation or \
+       cache.get('options') != options:
+        return {}
+    return cache['rss']
+
+def saveSweep(savefile, results, generation=None, options={}):
+    """ Saves the RSS of each k (atomically: an interrupted save keeps the
+    previous file) """
+    f = open(savefile + '.tmp', 'wb')
+    try:
+        pickle.dump({ 'generation':generation, 'options':options, 'rss':results }, f)
+    finally:
+        f.close()
+    os.rename(savefile + '.tmp', savefile)
+
 class VectorSpace:
     index = None
     indexer = None
     vectorIndex = None
+    norms = None        # Length of every document vector
     numberOfTerms = 0
     numberOfDocs = 0
+    numberOfRows = 0    # Largest docId + 1: docIds of deleted pages are unused
+    docIds = None       # Sorted array of the docIds in use
+    columns = None      # Maps each term to its column in the vectors
+    idf = None          # idf of each column
+    clusters = None     # ClusterModel loaded from disk
     
-    def __init__(self, iIndex, iIndexer):
+    def __init__(self, iIndex, iIndexer, vocabulary=None):
+        """ vocabulary: (columns, idf) as returned by InvertedIndex.loadVocabulary,
+        computed from the index if None. Either way, columns follow the sorted
+        order of the terms, so they do not depend on dictionary ordering. """
         self.index = iIndex
         self.indexer = iIndexer
         self.numberOfTerms = len(self.index)
         self.numberOfDocs = len(self.indexer.docL)
+        self.docIds = array(sorted(self.indexer.docL), dtype=int64)
+        self.numberOfRows = int(self.docIds[-1]) + 1 if self.numberOfDocs else 0
+        if vocabulary is None:
+            self.columns = {}
+            idf = []
+            for term in sorted(self.index):
+                self.columns[term] = len(idf)
+                df = self.index.df(term)
+                idf.append(math.log( (float(self.numberOfDocs)/df), 10 ))
+            self.idf = array(idf)
+        else:
+            self.columns = vocabulary[0]
+            self.idf = array(vocabulary[1])
+            if len(self.columns) != self.numberOfTerms:
+                raise ValueError("Vocabulary does not match the index")
     
     def computeIDF(self, term):
-        df = self.index.df(term)
-        return math.log( (float(self.numberOfDocs)/df), 10 )
+        return self.idf[self.columns[term]]
 
     def buildVectors(self):
-        # iterate the index and swap 0 to tfidf where applicable
-        self.vectorIndex = zeros( (self.numberOfDocs, self.numberOfTerms) )
-        pos = 0
-        for term in self.index: #this gives "ball"
-            idf = self.computeIDF(term)
-            for entry in self.index[term]: #this gives [ [25, 1], [587, 6], .... ]
-                self.vectorIndex[entry[0], pos] = entry[1]*idf
-            pos += 1
-            
-    def buildQueryVector(self, terms):
+        # Only the non-zero tf-idf weights are stored (see SparseMatrix)
+        self.vectorIndex = buildMatrix(self.index, self.columns, self.idf, self.numberOfRows)
+        self.norms = self.vectorIndex.rowLengths()
+
+    def buildSparseQueryVector(self, terms):
+        """ Query vector as (columns, weights), in O(number of terms).
+        Terms missing from the vocabulary are ignored. """
         termDict = termCount(terms)
+        cols = [ self.columns[term] for term in termDict if term in self.columns ]
+        counts = [ termDict[term] for term in termDict if term in self.columns ]
+        cols = array(cols, dtype=int64)
+        return cols, array(counts, dtype=float64) * self.idf[cols]
+
+    def buildQueryVector(self, terms):
+        """ Dense query vector (see buildSparseQueryVector) """
         vector = zeros( self.numberOfTerms )
-        # Returns empty vector if query is empty
-        #if not termDict:
-        #    return vector
-        pos = 0
-        for term in self.index:
-            if term in termDict:
-                vector[pos] = termDict[term]*self.computeIDF(term)
-            pos += 1
+        cols, weights = self.buildSparseQueryVector(terms)
+        vector[cols] = weights
         return vector
 
     def length(self, vectorID):
-        return vectorLength(self.vectorIndex[vectorID])
+        return self.norms[vectorID]
 
     def centroid(self, listOfIDs):
         c = zeros( (self.numberOfTerms) )
         for docId in listOfIDs:
-            c = add(c, self.vectorIndex[docId])
+            self.vectorIndex.addRow(c, docId)
         c = c / len(listOfIDs)
         return c
 
-    def randomSeed(self, k):
+    def randomSeed(self, k, rng=random):
         w = []
         # Initialize random class lists
         for i in range(k):
             w.append([])
         for docId in self.indexer.docL.keys():
-            w[random.randrange(0,k)].append(docId)
+            w[rng.randrange(0,k)].append(docId)
         return w
 
     def calculateClassRSS(self, v, c):
@@ -98,50 +551,172 @@ class VectorSpace:
             result += self.calculateClassRSS(w[k], u[k])
         return result
 
-    def kMeans(self, k):
-        # Initial seed and centroid
-        w = self.randomSeed(k)
-        u = []
-        for i in range(k):
-            u.append(self.centroid(w[i]))
-        thisRSS = self.calculateRSS(w, u)
-        prevRSS = 0
-        while thisRSS != prevRSS:
-            # Set each doc to the class with the nearest centroid
-            for i in range(k):
-                w[i] = []
-            for docId in self.indexer.docL.keys():
-                # distances from current docId to all centroids
-                distances = [ distance(u[i], self.vectorIndex[docId]) for i in range(k) ]
-                j = min(xrange(k), key=distances.__getitem__)
-                w[j].append(docId)
-            # Calculate the new centroids and RSS
-            for i in range(k):
-                u[i] = self.centroid(w[i])
-            prevRSS = thisRSS
-            thisRSS = self.calculateRSS(w, u)
-        return w, u, thisRSS
-
-    def kMeansBestOfN(self, k, n):
+    def kMeans(self, k, seed=None, **options):
+        """ seed: makes the clustering reproducible (random if None)
+        options: init, tolerance, maxIterations, batchSize, pruning, see kMeans """
+        return kMeans(self.vectorIndex, self.norms, self.indexer.docL.keys(), k, seed, **options)
+
+    def saveVectors(self, base=None):
+        """ Saves the document vectors for kMeansTask, see saveVectors, in
+        a new temporary folder if base is None. Returns the folder. """
+        if base is None:
+            base = tempfile.mkdtemp(prefix='vectors')
+        saveVectors(base, self.vectorIndex, self.norms, self.indexer.docL.keys())
+        return base
+
+    def kMeansBestOfN(self, k, n, seed=None, processes=1, **options):
+        """ seed: restart i uses seed+i, so the best of n is reproducible
+        processes: runs the restarts in a pool of processes, which read the
+                   document vectors from a temporary folder; same result as
+                   in one process for a given seed
+        options: passed to kMeans
+        """
+        seeds = [ None if seed is None else seed + i for i in range(n) ]
+        if processes > 1:
+            base = self.saveVectors()
+            try:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    results = pool.map(kMeansTask, [ (base, k, s, options) for s in seeds ])
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                shutil.rmtree(base)
+        else:
+            results = ( self.kMeans(k, s, **options) for s in seeds )
         rss = 0
         w = u = []
-        for i in range(n):
-            thisW, thisU, thisRSS = self.kMeans(k)
+        for thisW, thisU, thisRSS in results:
             if thisRSS < rss or rss == 0:
                 rss = thisRSS
                 w = thisW
                 u = thisU
         return w, u, rss
 
+    def kMeansSweep(self, ks, n, seed=None, processes=1, cachefile=None, generation=None, **options):
+        """ RSS of kMeansBestOfN(k, n*k, seed) for every k in ks, as a dict.
+        All the restarts of all the ks go to one pool of processes.
+        cachefile: keeps the RSS of each k as soon as it is known, so an
+                   interrupted sweep starts again where it stopped; the cache
+                   is only used if it was made from the same index generation
+                   and options
+        options: passed to kMeans
+        """
+        results = {}
+        if cachefile is not None:
+            results = loadSweep(cachefile, generation, options)
+        restarts = []       # (k, seed) of every restart left
+        remaining = {}      # Maps each k left to its number of restarts
+        for k in ks:
+            if k not in results:
+                remaining[k] = n*k
+                restarts += [ (k, None if seed is None else seed + i) for i in range(n*k) ]
+        if not restarts:
+            return results
+        pool = base = None
+        try:
+            if processes > 1:
+                base = self.saveVectors()
+                pool = multiprocessing.Pool(processes)
+                rssOf = pool.imap(kMeansRSS, [ (base, k, s, options) for k, s in restarts ])
+            else:
+                rssOf = ( self.kMeans(k, s, **options)[2] for k, s in restarts )
+            best = {}
+            for (k, s), rss in itertools.izip(restarts, rssOf):
+                # Lowest RSS, first one on ties, as in kMeansBestOfN
+                if k not in best or rss < best[k] or best[k] == 0:
+                    best[k] = rss
+                remaining[k] -= 1
+                if remaining[k] == 0:
+                    results[k] = best[k]
+                    if cachefile is not None:
+                        saveSweep(cachefile, results, generation, options)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if base is not None:
+                shutil.rmtree(base)
+        return results
+
+    def loadClusters(self, loadfile, generation=None):
+        """ Loads a clustering saved by ClusterModel.save; returns None if
+        the file is missing or was built from another index generation
+        generation: of the index the vectors were built from (the one on
+                    disk if None) """
+        if not os.path.exists(loadfile):
+            return None
+        if generation is None:
+            generation = wi.generation()
+        model = loadClusters(loadfile)
+        if model.generation != generation or model.centroids.shape[1] != self.numberOfTerms:
+            return None
+        self.clusters = model
+        return model
+
     def nearestCluster(self, w, u, vector):
-        distances = [ distance(u[i], vector) for i in range(len(u)) ]
+        """ w, u: clusters and centroids, or None to use the loaded clusters """
+        if w is None:
+            w = self.clusters.w
+            u = self.clusters.centroids
+        if isinstance(vector, tuple):
+            # Sparse query: |u-q|^2 = |u|^2 - 2u.q + |q|^2, where |q|^2 is the
+            # same for every centroid; only the query's columns are read
+            cols, weights = vector
+            u = asarray(u)
+            if self.clusters is not None and u is self.clusters.centroids:
+                uNorms = self.clusters.centroidNorms
+            else:
+                uNorms = sum(u**2.0, axis=1)
+            distances = (uNorms - 2.0*dot(u[:,cols], weights)).tolist()
+        else:
+            distances = [ distance(u[i], vector) for i in range(len(u)) ]
         j = min(xrange(len(u)), key=distances.__getitem__)
         return w[j]
     
     def queryCosine(self, queryVector, docId, closestCluster):
+        score = dot(queryVector, self.vectorIndex[docId])/(vectorLength(queryVector)*self.norms[docId]+1)
         if docId in closestCluster:
-            return 1.2*cosine(queryVector, self.vectorIndex[docId])
-        return cosine(queryVector, self.vectorIndex[docId])
+            return clusterBoost*score
+        return score
+
+    def queryCosines(self, queryVector, closestCluster):
+        """ queryCosine of every document at once: one matrix-vector product,
+        with the cluster boost applied as a mask """
+        scores = self.vectorIndex.dot(queryVector)/(vectorLength(queryVector)*self.norms+1)
+        boost = ones(self.numberOfRows)
+        boost[asarray(closestCluster, dtype=int64)] = clusterBoost
+        return scores*boost
 
     def cosineSort(self, idList, closestCluster, queryVector):
-        return sorted(idList, key=lambda x: self.queryCosine(queryVector, x, closestCluster), reverse=True)
+        idList = asarray(idList, dtype=int64)
+        scores = self.queryCosines(queryVector, closestCluster)[idList]
+        # Stable: documents with equal scores stay in idList order
+        return idList[argsort(-scores, kind='mergesort')].tolist()
+
+    def topN(self, closestCluster, queryVector, n):
+        """ The n best documents by queryCosine, best first.
+        Only the top n are sorted (argpartition), not the whole collection """
+        scores = self.queryCosines(queryVector, closestCluster)
+        if len(self.docIds) < len(scores):
+            # Leave out the unused docIds
+            ids = self.docIds
+            return ids[self.topScores(scores[ids], n)].tolist()
+        return self.topScores(scores, n).tolist()
+
+    def topScores(self, scores, n):
+        """ Positions of the n best scores, best first (see topN) """
+        if n < 1:
+            return zeros(0, dtype=int64)
+        if n < len(scores):
+            # n-th best score; among documents tied with it keep the lowest
+            # docIds, as a full stable sort would
+            kth = -partition(-scores, n-1)[n-1]
+            above = flatnonzero(scores > kth)
+            tied = flatnonzero(scores == kth)[:n-len(above)]
+            top = concatenate((above, tied))
+        else:
+            top = arange(len(scores))
+        # Best score first; ties in docId order, as in cosineSort
+        return top[lexsort((top, -scores[top]))]
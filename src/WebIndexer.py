@@ -2,16 +2,51 @@
 
 """WebIndexer.py
 
-Parses and indexes a directory of crawled web pages using SPIMI
+Parses and indexes crawled web pages using SPIMI.
+The pages are read from a directory, or straight from an archive without
+extracting it: zip, tar (optionally compressed) or a file of concatenated
+WARC records.
 """
 
-import re, csv, hashlib, os.path
+import re, csv, hashlib, htmlentitydefs, os.path, sys, multiprocessing, subprocess, zipfile, tarfile
+from numpy import zeros
 import Tokeniser as tk
 import InvertedIndex as ii
+import BinaryIndex as bi
+import Fingerprints as fp
+import SegmentedIndex as sg
 
 encoding = "iso-8859-1"
 wTitle   = 3
 wHeader  = 2
+memoryBudget = 64*1024*1024 # Default SPIMI block size, in bytes of memory
+slicePages = 100            # Pages read by a worker at a time (parallel spimi)
+
+# HTML, compiled once
+regexBody   = re.compile(r'(?<=<body)(?:.*?>)(.*)(?=<\/body>)', flags=(re.DOTALL|re.IGNORECASE))
+regexStrip  = re.compile(r'<[^>]*>|&#?\w+;', flags=re.DOTALL)
+regexTag    = re.compile(r'<[^>]*>', flags=re.DOTALL)
+regexEntity = re.compile(r'&(#?\w+);')
+# The markup that decides where text goes: comments and the tags of the
+# title, headers, body, scripts and styles (closing slash and name as groups)
+regexEvent  = re.compile(r'<!--.*?-->|<(/?)(title|h[1-6]|body|script|style)\b[^>]*>', flags=(re.DOTALL|re.IGNORECASE))
+# End of the tags whose content is not text
+regexRawEnd = { 'script': re.compile(r'</script\s*>', flags=re.IGNORECASE),
+                'style':  re.compile(r'</style\s*>', flags=re.IGNORECASE) }
+
+def entity(name):
+    """ Character of an entity ("amp", "#38" or "#x26"), None if unknown """
+    try:
+        if name[:2] == "#x":
+            return unichr(int(name[2:], 16))
+        if name[:1] == "#":
+            return unichr(int(name[1:]))
+    except ValueError:
+        return None
+    codepoint = htmlentitydefs.name2codepoint.get(name)
+    if codepoint is None:
+        return None
+    return unichr(codepoint)
 
 # From effbot.org/zone/re-sub.htm
 def strip_html(text):
@@ -19,57 +54,308 @@ def strip_html(text):
         text = m.group(0)
         if text[:1] == "<":
             return "" # ignore tags
-        if text[:2] == "&#":
-            try:
-                if text[:3] == "&#x":
-                    return unichr(int(text[3:-1], 16))
-                else:
-                    return unichr(int(text[2:-1]))
-            except ValueError:
-                pass
-        elif text[:1] == "&":
-            import htmlentitydefs
-            entity = htmlentitydefs.entitydefs.get(text[1:-1])
-            if entity:
-                if entity[:2] == "&#":
-                    try:
-                        return unichr(int(entity[2:-1]))
-                    except ValueError:
-                        pass
-                else:
-                    return unicode(entity, "iso-8859-1")
-        return text # leave as is
-    return re.sub("(?s)<[^>]*>|&#?\w+;", fixup, text)
+        char = entity(text[1:-1])
+        if char is None:
+            return text # leave as is
+        return char
+    return regexStrip.sub(fixup, text)
+
+entities = {}       # Maps the entities met so far to their text
+
+def decode(m):
+    text = entities.get(m.group(0))
+    if text is None:
+        text = entity(m.group(1))
+        if text is None:
+            text = m.group(0)
+        entities[m.group(0)] = text
+    return text
+
+def text(chunks):
+    """ Text of a list of HTML chunks: tags dropped, entities decoded """
+    text = regexTag.sub('', ''.join(chunks))
+    if '&' in text:
+        text = regexEntity.sub(decode, text)
+    return text
+
+def extract(txt, ordered=False):
+    """ Returns the title, header (h1-h6) and body text of a page, in one scan
+    of its HTML: the chunks between the title, header and body tags go to the
+    part of the page they belong to, scripts, styles and comments are
+    skipped. Only then are the other tags dropped and entities decoded, as in
+    strip_html. Header text is not part of the body.
+    ordered:    return the text of the 3 parts together, in page order
+    """
+    title, headers, body = [], [], []
+    if ordered:
+        title = headers = body  # One list keeps the chunks in page order
+    inTitle, inBody, depth = False, False, 0
+    part = None         # Where the text goes, None outside of the 3 parts
+    pos = 0
+    while True:
+        m = regexEvent.search(txt, pos)
+        if m is None:
+            if part is not None:
+                part.append(txt[pos:])
+            break
+        if part is not None and m.start() > pos:
+            part.append(txt[pos:m.start()])
+        pos = m.end()
+        closing, tag = m.groups()
+        if tag is None:
+            continue    # Comment
+        tag = tag.lower()
+        if tag in regexRawEnd:
+            if not closing:
+                end = regexRawEnd[tag].search(txt, pos)
+                pos = end.end() if end else len(txt)
+            continue
+        if tag == 'title':
+            inTitle = not closing
+        elif tag[0] == 'h':
+            depth = max(0, depth - 1) if closing else depth + 1
+        elif tag == 'body':
+            inBody = not closing
+        else:
+            continue
+        # Entering or leaving a part: words do not run over its edges
+        if part is not None:
+            part.append(' ')
+        if inTitle:
+            part = title
+        elif depth:
+            part = headers
+        elif inBody:
+            part = body
+        else:
+            part = None
+    if ordered:
+        return text(body)
+    return text(title), text(headers), text(body)
+
+def generation():
+    """ Returns the generation of the index on disk ("0" if never built)
+    The generation is bumped once every other index file has been written,
+    so a reader seeing a new generation can load a complete index.
+    """
+    if not os.path.exists("index/generation"):
+        return "0"
+    try:
+        f = open("index/generation", 'rb')
+        return f.read().strip()
+    finally:
+        f.close()
+
+def nextGeneration():
+    """ The generation saveGeneration writes next. New index files are
+    stamped with it, so that a file name is never used twice """
+    try:
+        current = int(generation())
+    except ValueError:
+        current = 0
+    return str(current + 1)
+
+def saveGeneration():
+    """ Marks the index on disk as a new generation """
+    try:
+        f = open("index/generation.tmp", 'wb')
+        f.write(nextGeneration())
+    finally:
+        f.close()
+    # rename is atomic: readers never see a half written generation
+    os.rename("index/generation.tmp", "index/generation")
 
 def allIndex(folder):
     result = []
     for root, dirs, files in os.walk(folder):
         for file in files:
-            test = re.findall(".*\.html", file)
-            if test:
+            if isPage(file):
                 result.append(root+"/"+file)
     return result
 
+def isPage(name):
+    return re.findall(".*\.html", os.path.basename(name))
+
+def sourceType(source):
+    """ Kind of page source: 'folder', 'zip', 'tar' or 'warc' """
+    if source is None or not os.path.isfile(source):
+        return 'folder'
+    if zipfile.is_zipfile(source):
+        return 'zip'
+    if tarfile.is_tarfile(source):
+        return 'tar'
+    return 'warc'
+
+def reads(read, name):
+    """ Whether a page's data is read: read is True (every page), False
+    (none) or the set of the names to read """
+    if read is True or read is False:
+        return read
+    return name in read
+
+def warcRecords(f, read=True):
+    """ Yields (uri, payload) for the response and resource records of a
+    file of concatenated WARC records:
+        WARC/1.0
+        WARC-Type: response
+        WARC-Target-URI: http://...
+        Content-Length: N
+        <blank line>
+        N bytes of payload
+    Payloads are skipped (and None) unless read says otherwise (see reads).
+    """
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue        # Separator between records
+        headers = {}
+        while True:
+            line = f.readline()
+            if not line.strip():
+                break
+            key, sep, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        uri = headers.get('warc-target-uri')
+        payload = None
+        if reads(read, uri):
+            payload = f.read(length)
+        else:
+            f.seek(length, 1)
+        if uri and headers.get('warc-type', 'resource') in ('response', 'resource'):
+            yield uri, payload
+
+def archivePages(source, kind, read=True):
+    """ Yields (name, data) for every page of an archive, in archive order.
+    The archive is opened once and read sequentially.
+    read: True, False or a set of names, see reads; the data of the pages
+          not read is None, and is not decompressed. Zip members are read
+          straight from the archive's directory; the other archives still
+          have to be walked through up to the pages read. """
+    if kind == 'zip':
+        archive = zipfile.ZipFile(source)
+        try:
+            for info in archive.infolist():
+                if isPage(info.filename):
+                    yield info.filename, (archive.read(info) if reads(read, info.filename) else None)
+        finally:
+            archive.close()
+    elif kind == 'tar':
+        archive = tarfile.open(source)
+        try:
+            for member in archive:
+                if member.isfile() and isPage(member.name):
+                    yield member.name, (archive.extractfile(member).read() if reads(read, member.name) else None)
+        finally:
+            archive.close()
+    else:
+        f = open(source, 'rb')
+        try:
+            for uri, payload in warcRecords(f, read):
+                yield uri, payload
+        finally:
+            f.close()
+
+def checksum(string):
+    """ Fingerprint used to detect duplicate pages """
+    return hashlib.md5(string.encode("utf8")).digest()
+
+def fingerprint(body, near):
+    """ (checksum, SimHash or None) of a page body """
+    if near:
+        return checksum(body), fp.simhash(strip_html(body))
+    return checksum(body), None
+
+def split(sequence, n):
+    """ Splits a list into at most n contiguous, non-empty slices """
+    slices = [ sequence[i*len(sequence)//n : (i+1)*len(sequence)//n] for i in range(n) ]
+    return [ s for s in slices if s ]
+
+# Parallel indexing: run in worker processes by WebIndexer.spimi
+
+def checksumSlice(task):
+    """ (body fingerprint, text) of each file, None for files without a
+    body: the text is indexed without reading and decoding the file again """
+    source, kind, near, docs = task
+    indexer = WebIndexer(folder=None)
+    indexer.source, indexer.kind = source, kind
+    result = []
+    for doc, data in indexer.documents(docs):
+        content = indexer.content(data)
+        if content is None:
+            result.append(None)
+        else:
+            txt, body = content
+            result.append( (fingerprint(body, near), txt) )
+    return result
+
+def indexSlice(task):
+    """ Indexes (docId, file, text) triples, whose docIds were assigned (and
+    duplicates removed) by the coordinator, into SPIMI blocks.
+    Returns the blocks' base names and the slice's doc lengths and urls """
+    prefix, pages, tokeniser, blockSize, budget = task
+    indexer = WebIndexer(folder=None, blockSize=blockSize, memoryBudget=budget)
+    index = ii.InvertedIndex()
+    blocks = []
+    files = 0
+    for docId, doc, txt in pages:
+        indexer.docId = docId
+        indexer.indexDocument(doc, txt, index, tokeniser)
+        files += 1
+        if indexer.blockFull(index, files):
+            blocks.append(indexer.saveBlock(index, prefix+str(len(blocks))))
+            files = 0
+    if len(index) > 0:
+        blocks.append(indexer.saveBlock(index, prefix+str(len(blocks))))
+    return blocks, indexer.docL, indexer.urls
+
 # I/O
 
 class WebIndexer:
+    source = None       # Folder or archive of pages
+    kind = 'folder'     # See sourceType
     fileList = []       # List of files to index
-    checksums = []      # List of checksum to check for duplicates
+    fingerprints = None # Fingerprints of the pages, to skip duplicates
     urls = {}           # Maps docId to urls
     docL = {}           # Maps docId to doc length
-    block = 0           # Block size in number of files for SPIMI
+    block = None        # Maximum block size in number of files for SPIMI
+    budget = 0          # Maximum block size in bytes of memory for SPIMI
     docId = 0           # Counter to keep track of current doc ID
+    maxSegments = 4     # update compacts the index past this many deltas
+    compaction = None   # subprocess.Popen of the last compactInBackground
+    exportCSV = False   # spimi and compact also write the index as text
+                        # (index/fullindex.csv, see exportIndex)
 
-    def __init__(self, folder='encs.concordia.ca', blockSize=1):
-        """ ReuterIndexer
-        folder:     Folder of *.sgm files to parse
-        blockSize:  Specify a block size for SPIMI in number of files
+    def __init__(self, folder='encs.concordia.ca', blockSize=None, memoryBudget=memoryBudget, nearDuplicates=None):
+        """ WebIndexer
+        folder:       Folder of *.html files to parse, or an archive of
+                      them (zip, tar or WARC)
+        blockSize:    Optionally limit SPIMI blocks to a number of files
+        memoryBudget: A SPIMI block is written to disk as soon as the
+                      index is estimated to use this many bytes
+        nearDuplicates: Also skip pages whose SimHash is at most this many
+                      bits away from an indexed page's (None: exact only)
         """
-        if blockSize > 1:
-            self.block = blockSize
+        if blockSize is not None and blockSize < 1:
+            blockSize = 1
+        self.block = blockSize
+        self.budget = memoryBudget
+        # Per instance state: several indexers (e.g. an old and a reloaded
+        # index in the search daemon) must not share their tables
+        self.fingerprints = fp.Fingerprints(nearDuplicates)
+        self.urls = {}
+        self.docL = {}
+        self.docId = 0
+        self.source = folder
+        self.kind = sourceType(folder)
+        self.fileList = []
+        if self.kind == 'folder':
+            if folder is not None:
+                self.fileList = allIndex(folder)
         else:
-            self.block = 1
-        self.fileList = allIndex(folder)
+            self.fileList = [ name for name, data in archivePages(folder, self.kind, read=False) ]
 
     def save(self):
         """ Saves the document length information as a CSV
@@ -92,6 +378,7 @@ class WebIndexer:
                 writer.writerow( { fields[0]:key, fields[1]:self.urls[key] } )
         finally:
             f.close()
+        self.fingerprints.save("index/fingerprints.csv")
 
     def load(self):
         """ loads the document length information from a CSV
@@ -112,6 +399,8 @@ class WebIndexer:
                 self.urls[int(row['docId'])] = row['url']
         finally:
             f.close()
+        if os.path.exists("index/fingerprints.csv"):
+            self.fingerprints.load("index/fingerprints.csv")
 
     def avgL(self):
         l = 0
@@ -120,108 +409,352 @@ class WebIndexer:
         return float(l) / float( len(self.docL) )
 
     def uniqueChecksum(self, string):
-        string = string.encode("utf8")
-        newChecksum = hashlib.md5(string).digest()
-        for checksum in self.checksums:
-            if newChecksum == checksum:
-                return False
-        self.checksums.append(newChecksum)
-        return True
-
-    def parse(self, doc, index, tokeniser):
-        """ Parse a single file and add to InvertedIndex """
-        try:
-            f = open(doc, 'rb')
-            
-            regexTitle  = re.compile(r'(?<=<title>)(.*)(?=<\/title>)', flags=(re.DOTALL|re.IGNORECASE))
-            regexHeader = re.compile(r'(?<=<h)(?:.*?>)(.*?)(?=<\/h)(?:.*?>)', flags=(re.DOTALL|re.IGNORECASE))
-            regexBody   = re.compile(r'(?<=<body)(?:.*?>)(.*)(?=<\/body>)', flags=(re.DOTALL|re.IGNORECASE))
-            regexScript = re.compile(r'<script.*?<\/script>', flags=re.DOTALL)
-            
-            txt = f.read().decode(encoding)
-
-            # Filter files without body
-            results = regexBody.findall(txt)
-            if not results:
-                return 0
-            body = results[0]
-            
-            # Check for duplicates
-            if not self.uniqueChecksum(body):
-                return 0
-            
-            self.docL[self.docId] = 0
-
-            # Capture title
-            title = ""
-            results = regexTitle.findall(txt)
-            if results:
-                title = results[0]
-            title = strip_html(title)
-            terms = tokeniser.tokenise(title)
-            self.docL[self.docId] += len(terms) * wTitle
-            for i in range(wTitle):
+        return self.uniqueDigest(*fingerprint(string, self.fingerprints.distance is not None))
+
+    def uniqueDigest(self, digest, simhash=None):
+        """ False if the page is a duplicate, else remembers it as self.docId """
+        return self.fingerprints.unique(self.docId, digest, simhash)
+
+    def documents(self, docs):
+        """ Yields (doc, raw data) for a list of files from fileList.
+        Archives are read in one pass, in archive order (which is the order
+        of fileList); only the files listed are decompressed. """
+        if self.kind == 'folder':
+            for doc in docs:
+                try:
+                    f = open(doc, 'rb')
+                    data = f.read()
+                finally:
+                    f.close()
+                yield doc, data
+        else:
+            wanted = set(docs)
+            for name, data in archivePages(self.source, self.kind, read=set(wanted)):
+                if name in wanted:
+                    wanted.discard(name)
+                    yield name, data
+                    if not wanted:
+                        break
+
+    def read(self, doc):
+        """ Returns the decoded text of a file and its body,
+        or None if it has no body """
+        for name, data in self.documents([doc]):
+            return self.content(data)
+
+    def content(self, data):
+        """ Decodes a file's data; returns its text and its body,
+        or None if it has no body """
+        txt = data.decode(encoding)
+        results = regexBody.findall(txt)
+        if not results:
+            return None
+        return txt, results[0]
+
+    def parse(self, doc, index, tokeniser, data=None):
+        """ Parse a single file and add to InvertedIndex
+        data: the file's content, if already read """
+        if data is None:
+            content = self.read(doc)
+        else:
+            content = self.content(data)
+        # Filter files without body
+        if content is None:
+            return 0
+        txt, body = content
+
+        # Check for duplicates
+        if not self.uniqueChecksum(body):
+            return 0
+
+        self.indexDocument(doc, txt, index, tokeniser)
+
+    def indexDocument(self, doc, txt, index, tokeniser):
+        """ Add a parsed file to InvertedIndex as document self.docId """
+        title, headers, body = extract(txt)
+        self.docL[self.docId] = 0
+
+        # Each part weighs as many postings as its weight (weighted DOM)
+        parts = tokeniser.tokeniseMany( (title, headers, body) )
+        for terms, weight in zip(parts, (wTitle, wHeader, 1)):
+            self.docL[self.docId] += len(terms) * weight
+            for i in range(weight):
                 for term in terms:
                     index[term] = self.docId
 
-            # Capture headers
-            results = regexHeader.findall(txt)
-            for result in results:
-                header = strip_html(result)
-                terms = tokeniser.tokenise(header)
-                self.docL[self.docId] += len(terms) * wHeader
-                for i in range(wHeader):
-                    for term in terms:
-                        index[term] = self.docId
-
-            # Capture body
-            body = regexScript.sub('', body)
-            body = regexHeader.sub('', body)
-            body = strip_html(body)
-            terms = tokeniser.tokenise(body)
-            self.docL[self.docId] += len(terms)
-            for term in terms:
-                index[term] = self.docId
-
-            self.urls[self.docId] = doc
-            self.docId += 1
-        finally:
-            f.close()
+        self.urls[self.docId] = doc
+        self.docId += 1
     
-    def spimi(self, index, tokeniser=None):
-        """ Implements SPIMI index construction algorithm """
+    def spimi(self, index, tokeniser=None, processes=1):
+        """ Implements SPIMI index construction algorithm
+        processes:  number of worker processes parsing the files
+        """
         if tokeniser is None:
             tokeniser = tk.Tokeniser()
-        numberofblocks = ( len(self.fileList) + self.block - 1 ) // self.block
-        if numberofblocks < 1:
-            numberofblocks = 1
-        for n in range( numberofblocks ):
-            index.clear()
-            for doc in self.fileList[n*self.block: (n * self.block) + self.block]:
-                self.parse(doc, index, tokeniser)
-            ii.save("index/index"+str(n)+".csv", index)
-        ii.mergeFile( "index/fullindex.csv", [ "index/index"+str(n)+".csv" for n in range(numberofblocks) ] )
-        self.save()
+        index.clear()
+        lock = sg.lock()
+        try:
+            if processes > 1:
+                blocks = self.parallelBlocks(tokeniser, processes)
+            else:
+                blocks = []
+                files = 0
+                for doc, data in self.documents(self.fileList):
+                    self.parse(doc, index, tokeniser, data)
+                    files += 1
+                    if self.blockFull(index, files):
+                        blocks.append(self.saveBlock(index, "index/index"+str(len(blocks))))
+                        files = 0
+            if len(index) > 0 or not blocks:
+                blocks.append(self.saveBlock(index, "index/index"+str(len(blocks))))
+            # Under a new name: the previous index may be mapped by a reader
+            main = sg.mainBase + "." + nextGeneration()
+            bi.merge( main, blocks )
+            for block in blocks:
+                bi.remove(block)
+            merged = bi.MappedIndex(main)
+            try:
+                ii.writeVocabulary("index/vocabulary.csv", merged.statistics(), len(self.docL))
+            finally:
+                merged.close()
+            self.exportIndex(main)
+            self.save()
+            # Updates made to the previous index are part of this one
+            sg.publish(main, [])
+            saveGeneration()
+        finally:
+            lock.close()
 
-    def display(self, docId):
+    def update(self, index, tokeniser=None, changed=None, deleted=None):
+        """ Updates the index on disk without rebuilding it (see
+        SegmentedIndex): new and modified pages are indexed into a new delta
+        segment, deleted and modified pages are tombstoned.
+        changed:    pages to index again; if None, every page of fileList,
+                    and the indexed pages no longer in fileList are deleted
+        deleted:    pages to delete
+        Returns the number of pages indexed and deleted.
+        """
+        if tokeniser is None:
+            tokeniser = tk.Tokeniser()
+        index.clear()
+        self.reap()
+        lock = sg.lock()
         try:
-            f = open(self.urls[docId], 'rb')
-            
-            regexBody = re.compile(r'(?<=<body)(?:.*?>)(.*)(?=</body>)', flags=(re.DOTALL|re.IGNORECASE))
-            regexScript = re.compile(r'<script.*?<\/script>', flags=re.DOTALL)
-            
-            # Decode and find body
-            txt = f.read().decode(encoding)
-            body = ""
-            result = regexBody.findall(txt)
-            if result:
-                body = result[0]
-            
-            # Remove scripts, strip tags and convert special characters
-            body = regexScript.sub('', body)
-            body = strip_html(body)
+            self.load()
+            main, deltas, tombstonesFile = sg.manifest()
+            dead = sg.loadTombstones(tombstonesFile)
+            # New docIds follow every docId ever given, deleted ones included
+            self.docId = max([len(dead)] + [ docId+1 for docId in self.urls ])
+            docIds = dict( [ (url, docId) for docId, url in self.urls.items() ] )
+            if changed is None:
+                changed = self.fileList
+                present = set(self.fileList)
+                deleted = [ url for url in docIds if url not in present ]
+            removed = []
+            for url in deleted or []:
+                if url in docIds:
+                    removed.append(self.forget(docIds[url]))
 
-            print self.urls[docId]
-            print body
+            near = self.fingerprints.distance is not None
+            added = 0
+            blocks = []
+            files = 0
+            for doc, data in self.documents(changed):
+                content = self.content(data)
+                old = docIds.get(doc)
+                if content is None:
+                    if old is not None:
+                        removed.append(self.forget(old))
+                    continue
+                txt, body = content
+                digest, simhash = fingerprint(body, near)
+                if old is not None:
+                    if self.fingerprints.digestOf(old) == digest:
+                        continue    # Unchanged
+                    # Modified: not a duplicate of its previous version
+                    removed.append(self.forget(old))
+                if not self.uniqueDigest(digest, simhash):
+                    continue
+                self.indexDocument(doc, txt, index, tokeniser)
+                added += 1
+                files += 1
+                if self.blockFull(index, files):
+                    blocks.append(self.saveBlock(index, "index/index"+str(len(blocks))))
+                    files = 0
+            if not added and not removed:
+                return 0, 0
+
+            stamp = nextGeneration()
+            if added:
+                if len(index) > 0:
+                    blocks.append(self.saveBlock(index, "index/index"+str(len(blocks))))
+                deltas.append(sg.newSegment(stamp))
+                bi.merge( deltas[-1], blocks )
+                for block in blocks:
+                    bi.remove(block)
+            tombstones = zeros(self.docId, dtype=bool)
+            tombstones[:len(dead)] = dead
+            tombstones[removed] = True
+
+            view = sg.SegmentedIndex(main, deltas, tombstones)
+            try:
+                ii.writeVocabulary("index/vocabulary.csv", view.statistics(), len(self.docL))
+            finally:
+                view.close()
+            self.exportIndex(None)
+            self.save()
+            sg.publish(main, deltas, sg.saveTombstones(tombstones, stamp))
+            saveGeneration()
         finally:
-            f.close()
+            lock.close()
+        if len(deltas) > self.maxSegments:
+            self.compactInBackground()
+        return added, len(removed)
+
+    def forget(self, docId):
+        """ Removes a page from the tables; returns its docId """
+        del self.urls[docId]
+        del self.docL[docId]
+        self.fingerprints.remove(docId)
+        return docId
+
+    def compact(self):
+        """ Merges the delta segments into the main index, leaving out the
+        tombstoned documents. Nothing refers to their docIds afterwards, so
+        update may give the ones above the last page left to new pages. """
+        lock = sg.lock()
+        try:
+            if not sg.isSegmented():
+                return
+            # A new main index, published with the segments and tombstones
+            # it replaces: readers never see it with them. The documents and
+            # their docIds do not change, so neither does the generation (nor
+            # the clusters and k-means results saved for it); at most one
+            # compaction per generation, update makes the next one
+            main = sg.mainBase + "." + generation() + "c"
+            view = sg.SegmentedIndex()
+            writer = bi.Writer(main)
+            try:
+                for term in view:
+                    writer.add(term, view[term])
+            finally:
+                writer.close()
+                view.close()
+            self.exportIndex(main)
+            # The vocabulary, urls and doc lengths were saved by update
+            sg.publish(main, [])
+        finally:
+            lock.close()
+
+    def exportIndex(self, main):
+        """ Writes the main index main as text if exportCSV; otherwise, or
+        if main is None (an update: the text copy is written again by the
+        next compaction), removes the copy left by an earlier build, which
+        no longer matches the index """
+        csvfile = sg.mainBase + ".csv"
+        if self.exportCSV and main is not None:
+            bi.saveCSV(main, csvfile)
+        elif os.path.exists(csvfile):
+            os.remove(csvfile)
+
+    def compactInBackground(self):
+        """ Runs compact in another process, which is returned (unless the
+        previous one is still running: it is returned instead).
+        The process is detached: it has its own session and no standard
+        streams, so this one (e.g. buildIndex.cgi after an update) can exit
+        and its request end without waiting for the compaction. """
+        self.reap()
+        if self.compaction is None:
+            command = "import sys; sys.path.insert(0, %r); import WebIndexer; " \
+                      "indexer = WebIndexer.WebIndexer(None); indexer.exportCSV = %r; " \
+                      "indexer.compact()" % \
+                      (os.path.dirname(os.path.abspath(__file__)), self.exportCSV)
+            devnull = open(os.devnull, 'r+b')
+            try:
+                self.compaction = subprocess.Popen([sys.executable, '-c', command],
+                                                   stdin=devnull, stdout=devnull, stderr=devnull,
+                                                   close_fds=True, preexec_fn=os.setsid)
+            finally:
+                devnull.close()
+        return self.compaction
+
+    def reap(self):
+        """ Waits for the process of compactInBackground if it has ended """
+        if self.compaction is not None and self.compaction.poll() is not None:
+            self.compaction = None
+
+    def parallelBlocks(self, tokeniser, processes):
+        """ Parses the files in a pool of processes, returns their blocks.
+        The workers read, decode and fingerprint slices of the files; as
+        their results come in (in file order), the duplicates are removed
+        here and docIds assigned. The pages kept go back to the workers,
+        text included, in parts of consecutive docIds, each indexed into its
+        own blocks: the blocks can be merged as if they had been built one
+        after the other. A part ends once its text reaches the memory budget
+        of a worker, or at 1/processes of the files so that every worker has
+        one: mostly a block per part.
+        """
+        # Every worker holds a block in memory: share the budget
+        budget = self.budget // processes
+        near = self.fingerprints.distance is not None
+        slices = split(self.fileList, max(4*processes, len(self.fileList) // slicePages))
+        partPages = -(-len(self.fileList) // processes)
+        pool = multiprocessing.Pool(processes)
+        try:
+            def readSlice(docs):
+                return pool.apply_async(checksumSlice, [ (self.source, self.kind, near, docs) ])
+            def indexPart(part):
+                prefix = "index/index" + str(len(parts)) + "_"
+                return pool.apply_async(indexSlice, [ (prefix, part, tokeniser, self.block, budget) ])
+            # Only a few slices are read ahead: a text is kept in memory
+            # until its part is indexed
+            ahead = 2*processes
+            reading = [ readSlice(docs) for docs in slices[:ahead] ]
+            parts = []
+            part, size = [], 0
+            for n in range(len(slices)):
+                results = reading[n].get()
+                reading[n] = None
+                if n + ahead < len(slices):
+                    reading.append(readSlice(slices[n + ahead]))
+                for doc, result in zip(slices[n], results):
+                    if result is None or not self.uniqueDigest(*result[0]):
+                        continue
+                    part.append( (self.docId, doc, result[1]) )
+                    self.docId += 1
+                    size += len(result[1])
+                    if size >= budget or len(part) >= partPages:
+                        parts.append(indexPart(part))
+                        part, size = [], 0
+            if part:
+                parts.append(indexPart(part))
+            results = [ p.get() for p in parts ]
+        finally:
+            pool.close()
+            pool.join()
+        blocks = []
+        for workerBlocks, docL, urls in results:
+            blocks += workerBlocks
+            self.docL.update(docL)
+            self.urls.update(urls)
+        return blocks
+
+    def blockFull(self, index, files):
+        """ True once a SPIMI block reaches the memory budget (or the
+        optional number of files) """
+        return index.memoryEstimate() >= self.budget or (self.block is not None and files >= self.block)
+
+    def saveBlock(self, index, base):
+        """ Saves a SPIMI block (compressed, see BinaryIndex) and empties the
+        index; returns the block's base name """
+        bi.save(base, index)
+        index.clear()
+        return base
+
+    def display(self, docId):
+        for doc, data in self.documents([self.urls[docId]]):
+            # Decode, strip tags and scripts, convert special characters
+            page = extract(data.decode(encoding), ordered=True)
+
+            print self.urls[docId]
+            print page
@@ -0,0 +1,4 @@
+"""Equivalence checks of the fast code paths against the simple ones they
+replace. Run from the top folder with Python 2:
+    python -m unittest discover tests
+"""
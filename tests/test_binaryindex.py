@@ -0,0 +1,32 @@
+"""test_binaryindex.py
+
+The variable-byte codec of the binary index.
+"""
+
+import os, sys, random, unittest
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(top, 'src'))
+
+from numpy import array, uint64
+import BinaryIndex as bi
+
+class VarintTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        rng = random.Random(5)
+        values = [0, 1, 127, 128, 16383, 16384, 2**21-1, 2**21, 2**28, 2**35-1]
+        values += [ rng.randint(0, 2**rng.randint(1, 35)-1) for i in range(1000) ]
+        data = bi.encodeVarints(values)
+        self.assertTrue((bi.decodeVarints(data) == array(values, dtype=uint64)).all())
+        self.assertEqual(len(bi.decodeVarints(bi.encodeVarints([]))), 0)
+
+    def testPostingsRoundTrip(self):
+        rng = random.Random(6)
+        docIds = sorted(rng.sample(range(100000), 500))
+        postings = [ [docId, rng.randint(1, 300)] for docId in docIds ]
+        skips, data = bi.encodePostings(postings)
+        self.assertEqual(bi.decodePostings(data).tolist(), postings)
+        self.assertEqual([ list(p) for p in bi.iterDecode(data) ], postings)
+
+if __name__ == '__main__':
+    unittest.main()
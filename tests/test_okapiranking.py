@@ -0,0 +1,62 @@
+"""test_okapiranking.py
+
+BM25 scores against a loop over the postings, ties included.
+"""
+
+import os, sys, math, random, unittest
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(top, 'src'))
+
+import OkapiRanking as ok
+import InvertedIndex as ii
+import WebIndexer as wi
+
+class OkapiRankingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        self.index = ii.InvertedIndex()
+        self.indexer = wi.WebIndexer(None)
+        for docId in range(0, 60, 2):
+            self.indexer.docL[docId] = rng.randint(5, 40)
+        for term in ['a', 'b', 'c', 'd', 'e']:
+            docIds = sorted(rng.sample(sorted(self.indexer.docL), rng.randint(1, 30)))
+            self.index[term] = [ [docId, rng.randint(1, 4)] for docId in docIds ]
+        self.ranking = ok.OkapiRanking(self.index, self.indexer)
+
+    def bruteForce(self, terms, k, b, n):
+        N = len(self.indexer.docL)
+        avgL = self.indexer.avgL()
+        rsv = {}
+        for term in set(terms):
+            if term not in self.index:
+                continue
+            idf = math.log(float(N)/len(self.index[term]), 10)
+            for docId, tf in self.index[term]:
+                L = self.indexer.docL[docId]
+                rsv[docId] = rsv.get(docId, 0.0) + \
+                             idf*(k+1)*tf/(k*((1-b) + b*L/avgL) + tf)
+        found = [ (docId, score) for docId, score in rsv.items() if score > 0 ]
+        return sorted(found, key=lambda x: (-x[1], x[0]))[:n]
+
+    def testScores(self):
+        for terms in (['a'], ['a', 'b'], ['b', 'b', 'c', 'z'], ['z'],
+                      ['a', 'b', 'c', 'd', 'e']):
+            for k, b in ((1.2, 0.75), (2.0, 0.3), (1.2, 0.75)):
+                for n in (0, 1, 5, 100):
+                    result = self.ranking.scores(terms, k, b, n)
+                    expected = self.bruteForce(terms, k, b, n)
+                    self.assertEqual([ d for d, s in result ], [ d for d, s in expected ])
+                    for (d1, s1), (d2, s2) in zip(result, expected):
+                        self.assertAlmostEqual(s1, s2)
+
+    def testTiesGoToTheSmallerDocId(self):
+        index = ii.InvertedIndex()
+        index['a'] = [ [docId, 1] for docId in range(0, 30, 2) ]
+        indexer = wi.WebIndexer(None)
+        indexer.docL = dict( (docId, 10) for docId in range(30) )
+        ranking = ok.OkapiRanking(index, indexer)
+        self.assertEqual(ranking.rsv(['a'], n=4), [0, 2, 4, 6])
+
+if __name__ == '__main__':
+    unittest.main()
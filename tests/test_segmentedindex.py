@@ -0,0 +1,86 @@
+"""test_segmentedindex.py
+
+An index updated with new, modified and deleted pages, then compacted, has
+the same postings and document lengths as one rebuilt from scratch.
+"""
+
+import os, sys, random, shutil, tempfile, unittest
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(top, 'src'))
+
+import InvertedIndex as ii
+import SegmentedIndex as sg
+import WebIndexer as wi
+import Tokeniser as tk
+
+page = """<html><head><title>%s</title></head>
+<body><h1>%s</h1><p>%s</p></body></html>"""
+
+class SegmentedIndexTest(unittest.TestCase):
+
+    words = ['apple', 'river', 'engine', 'student', 'library', 'music',
+             'garden', 'planet', 'window', 'coffee', 'harbor', 'science']
+
+    def setUp(self):
+        self.tokeniser = tk.Tokeniser(os.path.join(top, 'cornell.stop'))
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        # Index paths are relative ("index/...")
+        os.chdir(self.folder)
+        os.mkdir('index')
+        os.mkdir('pages')
+        rng = random.Random(11)
+        for i in range(12):
+            self.write(i, rng)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def write(self, i, rng):
+        text = ' '.join( rng.choice(self.words) for j in range(30) )
+        f = open('pages/page%d.html' % i, 'wb')
+        try:
+            f.write(page % ('Page %d' % i, rng.choice(self.words), text))
+        finally:
+            f.close()
+
+    def snapshot(self):
+        """ Postings and document lengths keyed by url, which unlike the
+        docIds do not depend on how the index was made """
+        indexer = wi.WebIndexer(None)
+        indexer.load()
+        index = sg.openIndex()
+        try:
+            postings = {}
+            for term in index:
+                for docId, tf in index[term]:
+                    postings[(term, indexer.urls[int(docId)])] = int(tf)
+        finally:
+            index.close()
+        lengths = dict( (indexer.urls[docId], indexer.docL[docId]) for docId in indexer.urls )
+        return postings, lengths
+
+    def testUpdateAndCompactMatchARebuild(self):
+        wi.WebIndexer('pages').spimi(ii.InvertedIndex(), self.tokeniser)
+        rng = random.Random(13)
+        os.remove('pages/page3.html')
+        os.remove('pages/page8.html')
+        self.write(5, rng)
+        self.write(12, rng)
+        indexer = wi.WebIndexer('pages')
+        self.assertEqual(indexer.update(ii.InvertedIndex(), self.tokeniser), (2, 3))
+        self.assertTrue(sg.isSegmented())
+        updated = self.snapshot()
+
+        wi.WebIndexer('pages').compact()
+        self.assertFalse(sg.isSegmented())
+        compacted = self.snapshot()
+
+        wi.WebIndexer('pages').spimi(ii.InvertedIndex(), self.tokeniser)
+        rebuilt = self.snapshot()
+        self.assertEqual(updated, rebuilt)
+        self.assertEqual(compacted, rebuilt)
+
+if __name__ == '__main__':
+    unittest.main()
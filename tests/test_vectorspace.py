@@ -0,0 +1,97 @@
+"""test_vectorspace.py
+
+k-means on the sparse document vectors against a reference written the way
+it was before it was vectorized (one document and one centroid at a time),
+and with pruning against without.
+"""
+
+import os, sys, random, unittest
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(top, 'src'))
+
+from numpy import zeros, sqrt, allclose
+import VectorSpace as vs
+
+def randomMatrix(rng, rows, columns, groups):
+    """ SparseMatrix of rows documents drawn around groups random topics,
+    with the lengths of its rows """
+    topics = [ rng.sample(range(columns), 6) for i in range(groups) ]
+    r, c, w = [], [], []
+    for row in range(rows):
+        terms = set(rng.choice(topics)[:rng.randint(3, 6)])
+        terms.update(rng.sample(range(columns), 2))
+        for column in sorted(terms):
+            r.append(row)
+            c.append(column)
+            w.append(rng.uniform(0.1, 2.0))
+    matrix = vs.SparseMatrix(r, c, w, (rows, columns))
+    return matrix, matrix.rowLengths()
+
+def loopKMeans(matrix, docIds, k, seed):
+    """ Random initial clusters drawn in docId order, then Lloyd iterations
+    until the RSS stops changing; the centroid of an empty cluster is 0 """
+    def centroid(cluster):
+        c = zeros(matrix.shape[1])
+        for docId in cluster:
+            c += matrix[docId]
+        if cluster:
+            c = c / len(cluster)
+        return c
+    def calculateRSS(w, u):
+        result = 0.0
+        for i in range(k):
+            for docId in w[i]:
+                result += ((u[i] - matrix[docId])**2.0).sum()
+        return result
+    rng = random.Random(seed)
+    w = [ [] for i in range(k) ]
+    for docId in docIds:
+        w[rng.randrange(0, k)].append(docId)
+    u = [ centroid(w[i]) for i in range(k) ]
+    thisRSS = calculateRSS(w, u)
+    prevRSS = 0
+    while thisRSS != prevRSS:
+        w = [ [] for i in range(k) ]
+        for docId in docIds:
+            distances = [ sqrt(((u[i] - matrix[docId])**2.0).sum()) for i in range(k) ]
+            w[distances.index(min(distances))].append(docId)
+        u = [ centroid(w[i]) for i in range(k) ]
+        prevRSS = thisRSS
+        thisRSS = calculateRSS(w, u)
+    return w, u, thisRSS
+
+class KMeansTest(unittest.TestCase):
+
+    def testSameClustersAsTheLoop(self):
+        rng = random.Random(7)
+        matrix, norms = randomMatrix(rng, 80, 40, 5)
+        # Not every row is a document, as with the docIds of a rebuilt index
+        docIds = [ docId for docId in range(80) if docId % 9 != 4 ]
+        for k in (2, 3, 5, 8):
+            for seed in range(4):
+                w1, u1, rss1 = vs.kMeans(matrix, norms, docIds, k, seed)
+                w2, u2, rss2 = loopKMeans(matrix, docIds, k, seed)
+                self.assertEqual(w1, w2)
+                self.assertAlmostEqual(rss1, rss2, places=6)
+                for c1, c2 in zip(u1, u2):
+                    self.assertTrue(allclose(c1, c2))
+
+    def testPruningGivesTheSameClusters(self):
+        rng = random.Random(7)
+        matrix, norms = randomMatrix(rng, 80, 40, 5)
+        # Not every row is a document, as with the docIds of a rebuilt index
+        docIds = [ docId for docId in range(80) if docId % 9 != 4 ]
+        for k in (2, 3, 6):
+            for seed in range(3):
+                for options in ({}, {'init':'kmeans++'},
+                                {'tolerance':1e-3, 'maxIterations':4}):
+                    w1, u1, rss1 = vs.kMeans(matrix, norms, docIds, k, seed, **options)
+                    w2, u2, rss2 = vs.kMeans(matrix, norms, docIds, k, seed,
+                                             pruning=True, **options)
+                    self.assertEqual(w1, w2)
+                    self.assertEqual(rss1, rss2)
+                    for c1, c2 in zip(u1, u2):
+                        self.assertTrue((c1 == c2).all())
+
+if __name__ == '__main__':
+    unittest.main()